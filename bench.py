@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Compare the HTML parser backends on saved listing pages
+#
+#   python bench.py georgia pages/georgia/*.html
+#
+# then run the state with PLUMBER_PARSER=<fastest matching backend>
+
+import os
+import sys
+import time
+import glob
+import importlib
+import tracemalloc
+import util
+
+from bs4 import FeatureNotFound
+
+BACKENDS = [ 'html.parser', 'lxml', 'html5lib' ]
+
+# Page parser of each state, extract_plumbers unless listed. Detail
+# parsers return one record per page. Kentucky is JSON only
+PARSERS = {
+    'mississippi': 'parse_records_page',
+    'rhodeisland': 'extract_details',
+    'texas': 'extract_listing' }
+DETAILS = { 'rhodeisland' }
+NO_HTML = { 'kentucky' }
+
+def load_pages(paths):
+
+    pages = []
+    for path in paths:
+        if os.path.isdir(path):
+            pages.extend(load_pages(sorted(glob.glob(os.path.join(path, '*')))))
+            continue
+        with open(path, 'r', encoding='utf8', errors='replace') as fp:
+            pages.append(fp.read())
+
+    return pages
+
+def extract_rows(extract, pages):
+    return [ row for html in pages for row in extract(html) ]
+
+def run(extract, pages, parser):
+
+    util.PARSER = parser
+
+    start = time.perf_counter()
+    rows = extract_rows(extract, pages)
+    elapsed = time.perf_counter() - start
+
+    # Separate pass, tracing slows the timed one down
+    tracemalloc.start()
+    extract_rows(extract, pages)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return rows, elapsed, peak
+
+def bench(state, pages):
+
+    module = importlib.import_module(state)
+    extract = getattr(module, PARSERS.get(state, 'extract_plumbers'))
+    if state in DETAILS:
+        parse = extract
+        extract = lambda html: [ parse(html) ]
+
+    baseline = None
+    print('{:12} {:>10} {:>12} {:>10}  {}'.format(
+        'parser', 'rows', 'rows/sec', 'peak MB', 'same rows'))
+
+    for parser in BACKENDS:
+        try:
+            rows, elapsed, peak = run(extract, pages, parser)
+        except FeatureNotFound:
+            print('{:12} not installed'.format(parser))
+            continue
+
+        if baseline is None: baseline = rows
+        rate = len(rows) / elapsed if elapsed else 0
+
+        print('{:12} {:>10} {:>12.0f} {:>10.1f}  {}'.format(
+            parser, len(rows), rate, peak / 2**20, rows == baseline))
+
+def main():
+
+    if len(sys.argv) < 3:
+        print('usage: bench.py STATE HTML_FILE_OR_DIR ...')
+        sys.exit(1)
+
+    state = sys.argv[1]
+    if state in NO_HTML:
+        print(state, 'has no HTML pages to parse')
+        sys.exit(1)
+
+    pages = load_pages(sys.argv[2:])
+    print('Benchmarking', state, 'on', len(pages), 'pages')
+    bench(state, pages)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Write every state and the combined national dataset as Parquet,
+# streamed from the record store a chunk at a time
+#
+#   python export.py                    # every state
+#   python export.py georgia texas --chunk 20000
+#
+# export/<state>.parquet keeps the columns of the state's CSV,
+# export/national.parquet the columns every state shares
+
+import os
+import argparse
+import importlib
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import util
+import runner
+
+EXPORT_DIR = 'export'
+NATIONAL = 'national'
+
+# Records per row group, each one gets its own min/max statistics
+CHUNK = 10000
+
+# Low cardinality text, stored as a dictionary per row group
+DICTIONARY = [ 'License Status', 'License Type', 'Profession', 'State',
+        'County', 'Classification', 'Method', 'Source' ]
+
+# Dates that don't say so in their name
+DATES = [ 'Renewal', 'Certificate Expires', 'Certificate Registered' ]
+
+NATIONAL_COLUMNS = util.COLUMNS + [
+        'License Type', 'Issue Date', 'Expiration Date', 'Source' ]
+
+def column_type(column):
+    if column.lower().endswith('date') or column in DATES:
+        return pa.date32()
+    if column in DICTIONARY:
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+def table_schema(columns):
+    return pa.schema([ pa.field(x, column_type(x)) for x in columns ])
+
+def parse_dates(values):
+
+    # Portals mix formats, the first one that parses wins
+    dates = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    for fmt in util.DATE_FORMATS:
+        parsed = pd.to_datetime(values, format=fmt, errors='coerce')
+        dates = dates.fillna(parsed)
+    return dates
+
+def text(value):
+    if isinstance(value, str): return value
+    if value is None or value is pd.NA or value != value: return None
+    return str(value)
+
+def to_arrow(df, schema):
+
+    arrays = []
+    for field in schema:
+        if field.name in df:
+            values = df[field.name]
+        else:
+            values = pd.Series(None, index=df.index, dtype=object)
+
+        if pa.types.is_date32(field.type):
+            dates = parse_dates(values.map(text))
+            arrays.append(pa.array(dates, from_pandas=True).cast(pa.date32()))
+            continue
+
+        array = pa.array(values.map(text), type=pa.string(), from_pandas=True)
+        if pa.types.is_dictionary(field.type):
+            array = array.dictionary_encode()
+        arrays.append(array)
+
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def open_writer(name, schema):
+    path = os.path.join(EXPORT_DIR, name + '.parquet')
+    writer = pq.ParquetWriter(path + '.tmp', schema,
+            compression='zstd', write_statistics=True)
+    return path, writer
+
+def close_writer(path, writer):
+    writer.close()
+    os.replace(path + '.tmp', path)
+
+def export_state(state, national, chunk=CHUNK):
+
+    module = importlib.import_module(state)
+    path, writer = None, None
+    rows = 0
+
+    # Same records export_csv sees, the old checkpoint included
+    records = util.state_records(module.STATE, module.FILENAME)
+
+    for batch in util.chunked(records, chunk):
+        df = module.export_table(batch)
+
+        # The first chunk fixes the state's columns
+        if writer is None:
+            path, writer = open_writer(state, table_schema(df.columns))
+        writer.write_table(to_arrow(df, writer.schema), row_group_size=chunk)
+
+        df['Source'] = module.STATE
+        national.write_table(to_arrow(df, national.schema), row_group_size=chunk)
+        rows += len(df)
+
+    if writer is not None:
+        close_writer(path, writer)
+    return rows
+
+def export_states(states, chunk=CHUNK):
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path, national = open_writer(NATIONAL, table_schema(NATIONAL_COLUMNS))
+    total = 0
+
+    try:
+        for state in states:
+            rows = export_state(state, national, chunk)
+            if rows:
+                print('{:14} {:>8} records'.format(state, rows))
+            else:
+                print('{:14} {:>8} records, nothing scraped, skipped'.format(state, rows))
+            total += rows
+    except BaseException:
+        national.close()
+        os.remove(path + '.tmp')
+        raise
+
+    if not total:
+        national.close()
+        os.remove(path + '.tmp')
+        print('No records in any state, nothing written')
+        return
+
+    close_writer(path, national)
+    print('{:14} {:>8} records'.format(NATIONAL, total))
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('states', nargs='*', help='states to export, all by default')
+    parser.add_argument('--chunk', type=int, default=CHUNK,
+            help='records per row group')
+    args = parser.parse_args()
+
+    unknown = set(args.states) - set(runner.STATES)
+    if unknown:
+        parser.error('unknown states: ' + ', '.join(sorted(unknown)))
+
+    export_states(args.states or list(runner.STATES), args.chunk)
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,27 @@
 #!/usr/bin/env python3
 
-import pandas as pd
 import re
 import util
-import nameparser
+import functools
 
-from collections import OrderedDict
-from bs4 import BeautifulSoup
 from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support.ui import Select
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
+from selenium.common.exceptions import TimeoutException
 
 URL = 'https://dphregprograms.iowa.gov/PublicPortal/Iowa/IDPH/publicSearch/publicSearch.jsp'
+FILENAME = 'iowa_ex.json'
+STATE = 'iowa'
 KEYS = ('License', 'Name', 'Program', 'City')
+FIELDS = {
+    'City': 'City',
+    'License Number': 'License',
+    'Full Name': 'Name',
+    'License Type': 'Type',
+    'License Status': 'Status',
+    'Issue Date': 'Issue',
+    'Expiration Date': 'Expiration',
+    'Speciality': 'Speciality' }
+PAGER = '//div[@id="paginateContainer"]//select'
 
 def prepare_scrape(driver: webdriver.Chrome):
 
@@ -30,24 +36,34 @@ def prepare_scrape(driver: webdriver.Chrome):
     # Wait for page
 
     elem = driver.find_element_by_id('btn_search')
-    driver.execute_script("arguments[0].click();", elem)
-    # Wait for page
+    search = lambda: driver.execute_script("arguments[0].click();", elem)
+    if not util.wait_for_change(driver, search, '#resulttable'):
+        raise TimeoutException('No search results')
+
+def page_count(driver):
+    elem = Select(driver.find_element_by_xpath(PAGER))
+    return max( int(x.get_attribute('value')) for x in elem.options )
+
+def current_page(driver):
+    elem = Select(driver.find_element_by_xpath(PAGER))
+    return int(elem.first_selected_option.get_attribute('value'))
 
 def click_page_button(driver: webdriver.Chrome, page):
 
-    query = '//div[@id="paginateContainer"]//select'
-    elem = Select(driver.find_element_by_xpath(query))
-    elem.select_by_value(str(page))
+    elem = Select(driver.find_element_by_xpath(PAGER))
+
+    select = lambda: elem.select_by_value(str(page))
+    if not util.wait_for_change(driver, select, '#resulttable'):
+        raise TimeoutException('Page {} did not load'.format(page))
 
 def parse_row(row):
+    cols = [ td.get_text(strip=True) for td in row.find_all('td', recursive=False) ]
+    anchor = row.find('a', attrs={ 'onclick': True })
+    return make_record(cols, anchor['onclick'])
 
-    data = dict()
-    cols = row.find_all('td', recursive=False)
-    for k, td in zip(KEYS, cols[1:]):
-        data[k] = td.get_text(strip=True)
+def make_record(cols, script):
 
-    anchor = row.find('a', attrs={ 'onclick': True })
-    script = anchor['onclick']
+    data = dict(zip(KEYS, cols[1:]))
 
     # Data that will be used to extract details later
     match = re.search(r'(\d+),\s(\d+)', script)
@@ -56,67 +72,59 @@ def parse_row(row):
 
     return data
 
+def browser_plumbers(driver):
+    for row in util.table_rows(driver, '#resulttable') or []:
+        script = next( a['onclick'] for a in row['anchors'] if a['onclick'] is not None )
+        yield make_record(row['cells'], script)
+
 def extract_plumbers(html):
 
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = util.soup(html)
     elem = soup.find('table', id='resulttable')
     rows = elem.tbody.find_all('tr', recursive=False)
 
     for tr in rows:
         yield parse_row(tr)
 
-def scrape_plumbers(driver):
+def scrape_shard(start, stop=None):
 
-    prepare_scrape(driver)
-    page = 1
+    # Pooled browsers come back on whatever page they were left on,
+    # the pager select jumps straight to the start
+    with util.driver_pool().driver(prepare_scrape) as driver:
+        page = start
+        while page < (stop or page_count(driver) + 1):
+            print('Scraping page', page)
+            navigate = functools.partial(click_page_button, driver, page) \
+                    if current_page(driver) != page else None
+            yield from util.page_rows(driver, (URL, page), navigate,
+                    extract_plumbers, browser_plumbers)
+            page += 1
 
-    while True:
-        print('Scraping page', page)
-        html = driver.page_source
-        yield from extract_plumbers(html)
+def scrape_plumbers(shards=util.BROWSERS):
 
-        if page >= 530: break
-        page += 1
+    with util.driver_pool().driver(prepare_scrape) as driver:
+        count = page_count(driver)
+    print('Found', count, 'pages')
 
-        click_page_button(driver, page)
+    yield from util.sharded(count, shards, scrape_shard)
 
-def format_record(record):
-
-    data = OrderedDict.fromkeys(util.COLUMNS)
-    name = nameparser.HumanName(record['Name'])
-
-    data['City'] = record['City']
-    data['Last Name'] = name.last
-    data['First Name'] = name.first
-    data['License Number'] = record['License']
-    data['Full Name'] = record['Name']
-    data['License Type'] = record['Program']
-
-    data['License Status'] = record.get('Status', '')
-    data['Issue Date'] = record.get('Issue', '')
-    data['Expiration Date'] = record.get('Expiration', '')
-    data['License Type'] = record.get('Type', '')
-    data['Speciality'] = record.get('Speciality', '')
-
-    return data
+def export_table(records):
+    return util.export_frame(records, FIELDS, name='Name')
 
 def export_csv():
-    data = util.read_json('iowa_ex.json')
-    df = pd.DataFrame([ format_record(x) for x in data ])
+    df = export_table(util.load_records(STATE, FILENAME))
     df.to_csv('./iowa.csv', index=None)
 
-def scrape_details(driver, record):
-
+def scrape_details(session, record):
 
     payload = { 'folderRSN': record['_folderRSN'], 'pRSN': record['_pRSN'] }
     url = 'https://dphregprograms.iowa.gov/PublicPortal/Iowa/IDPH/publicSearch/publicDetail.jsp'
 
     try:
-        s = util.session_from_driver(driver)
-        resp = s.post(url, data=payload)
+        resp = session.post(url, data=payload)
         html = resp.text
 
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = util.soup(html)
         td = soup.select('#license_detail td')
 
         record['Status'] = td[3].get_text(strip=True)
@@ -136,22 +144,17 @@ def unique_record(record):
 
 def main():
 
-    filename = 'iowa_ex.json'
-    results = util.read_json(filename)
-    scraped = set( unique_record(x) for x in results )
-
-    driver = webdriver.Chrome()
-    
-    for record in scrape_plumbers(driver):
-        if unique_record(record) not in scraped:
-            print('Scraping details', record['Name'])
-            details = scrape_details(driver, record)
-            results.append(details)
-            util.write_json(filename, results)
-        else:
-            print('Already scraped', record['License'])
-
-    util.write_json('iowa_ex.json', results)
+    # Details are posted from worker threads, so they share one
+    # session instead of reading cookies off the driver
+    with util.driver_pool().driver(prepare_scrape) as driver:
+        session = util.session_from_driver(driver)
+    scrape = functools.partial(scrape_details, session)
+
+    with util.RecordStore(STATE, unique_record, FILENAME) as store:
+        records = scrape_plumbers()
+        for details in util.fetch_details(records, scrape, store):
+            print('Scraped details', details['Name'])
+            store.append(details)
 
 if __name__ == '__main__':
     main()
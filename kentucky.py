@@ -1,72 +1,121 @@
 #!/usr/bin/env python3
 
 import requests as rq
-import time
-import json
+import math
+import functools
 import util
-import nameparser
-import pandas as pd
-
-from collections import OrderedDict
 
 URL = 'https://ky.joportal.com/License/Search'
+FILENAME = 'kentucky.json'
+STATE = 'kentucky'
+FIELDS = {
+    'City': 'City',
+    'State': 'CountyState',
+    'License Number': 'Number',
+    'License Status': 'Status',
+    'Full Name': 'FullName',
+    'License Type': 'Type',
+    'Expiration Date': 'ExpirationDate',
+    'Application Date': 'ApplicationDate',
+    'Renewal Date': 'RenewalDate' }
+PARAMS = {
+    'Division': 103, 'LicenseType': [13, 14],
+    'multiselect_LicenseType': [13, 14],
+    'LicenseNumber': '', 'BusinessName': '',
+    'LastName': '', 'FirstName': '', 'County': '' }
+
+# Largest first, the grid silently caps what it doesn't accept
+PAGE_SIZES = (1000, 500, 250, 100, 50)
+
+# Pages in flight at once
+WINDOW = 4
+
+def fetch_page(page, size):
+
+    # jqGrid's nd cache buster is left out so responses can be cached
+    payload = {
+        '_search': 'false',
+        'PageSize': size, 'PageNumber': page,
+        'OrderBy': 'Number', 'OrderByDirection': 'asc' }
 
-def fetch_plumbers(page):
+    resp = util.client().post(URL, params=PARAMS, data=payload)
+    resp.raise_for_status()
+    return resp.json()
 
-    params = {
-        'Division': 103, 'LicenseType': [13, 14],
-        'multiselect_LicenseType': [13, 14], 
-        'LicenseNumber': '', 'BusinessName': '', 
-        'LastName': '', 'FirstName': '', 'County': '' }
+def fetch_plumbers(page, size):
+    print('Fetching page', page)
+    return fetch_page(page, size).get('rows', [])
 
-    nd = int(time.time() * 1000)
-    payload = {
-        '_search': 'false', 'nd': nd,
-        'PageSize': 50, 'PageNumber': page,
-        'OrderBy': 'Number', 'OrderByDirection': 'asc' }
+def negotiate_page_size():
+
+    # A size the grid rejects outright errors out, try the next one.
+    # If every size comes back capped, the rows the first page brought
+    # are the grid's real page size
+    accepted = None
+    for size in PAGE_SIZES:
+        try:
+            data = fetch_page(1, size)
+        except (rq.RequestException, ValueError) as e:
+            print('Page size', size, 'rejected:', e)
+            continue
 
-    resp = rq.post(URL, params=params, data=payload)
-    data = resp.json()
+        rows = data.get('rows', [])
+        total = int(data.get('records') or len(rows))
+        accepted = size, total, rows
+        if len(rows) >= min(size, total):
+            break
 
-    return data.get('rows', [])
+    if accepted is None:
+        raise ValueError('No page size accepted')
 
-def scrape_plumbers():
-    for p in range(1, 250):
-        print('Fetching page', p)
-        yield from fetch_plumbers(p)
+    size, total, rows = accepted
+    if rows and len(rows) < min(size, total):
+        size = len(rows)
 
-def write_json(filename, data):
-    with open(filename, 'w', encoding='utf8') as fp:
-        json.dump(data, fp, indent=2)
+    print('Page size', size, 'for', total, 'records')
+    return size, total, rows
 
-def format_record(record):
+def scrape_plumbers(window=WINDOW):
 
-    data = OrderedDict.fromkeys(util.COLUMNS)
-    name = nameparser.HumanName(record['FullName'])
+    size, total, rows = negotiate_page_size()
+    count = len(rows)
+    yield from rows
 
-    data['City'] = record['City']
-    data['Last Name'] = name.last
-    data['First Name'] = name.first
-    data['State'] = record['CountyState']
-    data['License Number'] = record['Number']
-    data['License Status'] = record['Status']
-    data['Full Name'] = record['FullName']
-    data['License Type'] = record['Type']
-    data['Expiration Date'] = record['ExpirationDate']
-    data['Application Date'] = record['ApplicationDate']
-    data['Expiration Date'] = record['ExpirationDate']
-    data['Renewal Date'] = record['RenewalDate']
-    data['License Type'] = record['Type']
+    last = math.ceil(total / size) if size else 1
+    fetch = functools.partial(fetch_plumbers, size=size)
 
-    return data
+    for rows in util.ordered_map(fetch, range(2, last + 1), workers=window):
+        count += len(rows)
+        yield from rows
+
+    # Pages that came back short leave the rest past the last page
+    while count < total:
+        last += 1
+        rows = fetch(last)
+        if not rows: break
+        count += len(rows)
+        yield from rows
+
+    if count < total:
+        print('Kentucky: only', count, 'of', total, 'records returned')
+
+def unique_record(record):
+    return (record['Number'], record['Type'])
+
+def export_table(records):
+    return util.export_frame(records, FIELDS, name='FullName')
 
 def export_csv():
-    data = util.read_json('kentucky.json')
-    df = pd.DataFrame([ format_record(x) for x in data ])
+    df = export_table(util.load_records(STATE, FILENAME))
     df.to_csv('./kentucky.csv', index=None)
 
 def main():
-    pass
+
+    with util.RecordStore(STATE, unique_record, FILENAME) as store:
+        for record in scrape_plumbers():
+            store.append(record)
+
+        print('Kentucky records', len(store))
 
 if __name__ == '__main__':
     main()
@@ -1,24 +1,37 @@
 #!/usr/bin/env python3
 
-import requests as rq
 import pandas as pd
+import numpy as np
 import util
-import datetime as dt
-import nameparser
-
-from bs4 import BeautifulSoup
-from collections import OrderedDict
 
 from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
 
 URL = 'https://www.dllr.state.md.us/cgi-bin/ElectronicLicensing/OP_Search/OP_search.cgi?calling_app=PLM::PLM_personal_location'
+FILENAME = 'maryland_ex.json'
+STATE = 'maryland'
 KEYS = ('Name', 'City', 'State', 'Zip', 'Expiration', 'Category', 'Insured', 'License')
 
+ZIP_DATA = './data/md_zip_data.csv'
+YIELDS = './data/md_zip_yield.json'
+
+# Stop after this many queries in a row bring nothing new
+PATIENCE = 10
+
+FIELDS = {
+    'City': 'City',
+    'State': 'State',
+    'Zip Code': 'Zip',
+    'License Number': 'License',
+    'Full Name': 'Name',
+    'License Type': 'Category',
+    'Insured': 'Insured',
+    'Expiration Date': 'Expiration' }
+
 # Serach plumbers by zip code
 def fetch_plumbers(driver: webdriver.Chrome, zip_):
 
-    driver.get(URL)
+    util.browse(driver, lambda: driver.get(URL), 'www.dllr.state.md.us')
 
     # Enter zip code
     elem = driver.find_element_by_name('zip')
@@ -26,14 +39,13 @@ def fetch_plumbers(driver: webdriver.Chrome, zip_):
 
     # Click submit button
     elem = driver.find_element_by_name('Submit')
-    elem.click()
-
-    html = driver.page_source
-    return html
+    if not util.wait_for_change(driver, elem.click, 'body'):
+        raise TimeoutException('No results for zip {}'.format(zip_))
+    util.served(driver)
 
 def extract_plumbers(html):
 
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = util.soup(html)
     table = soup.find('table')
     if table is None: return
 
@@ -48,80 +60,133 @@ def find_element_by_xpath(driver, path):
         return None
 
 def parse_row(soup):
+    cols = [ td.get_text(strip=True) for td in soup.find_all('td') ]
+    return make_record(cols)
 
+def make_record(cols):
     data = dict.fromkeys(KEYS)
-    cols = soup.find_all('td')
-    for k, td in zip(KEYS, cols):
-        data[k] = td.get_text(strip=True)
-
+    data.update(zip(KEYS, cols))
     return data
 
+def browser_plumbers(driver):
+    rows = util.table_rows(driver, 'table', cells='td') or []
+    for row in rows[1:]:
+        yield make_record(row['cells'])
+
 def scrape_plumbers_location(driver, code):
 
-    html = fetch_plumbers(driver, code)
+    fetch_plumbers(driver, code)
 
     while True:
-        for data in extract_plumbers(html):
+        for data in util.read_page(driver, extract_plumbers, browser_plumbers):
             data['Zip'] = code
             yield data
 
         path = '//input[@value=" Next 50 "]'
         elem = find_element_by_xpath(driver, path)
         if elem is None: break
-        elem.click()
-
-
-def scrape_plumbers(driver):
-
-    df = pd.read_csv('./data/md_zip.csv')
-
-    for code in df.zip:
-        print('Scraping Zip Code', code)
-        yield from scrape_plumbers_location(driver, code)
-
-def format_record(record):
-
-    data = OrderedDict.fromkeys(util.COLUMNS)
-    name = nameparser.HumanName(record['Name'])
-
-    try:
-        exp = dt.datetime.strptime(record['Expiration'], '%Y-%m-%d')
-        data['License Status'] = 'Expired' \
-                if exp < dt.datetime.now() else 'Active'
-    except ValueError:
-        data['License Status'] = None
-
-    data['Last Name'] = name.last
-    data['First Name'] = name.first
-    data['City'] = record['City']
-    data['State'] = record['State']
-    data['Zip Code'] = record['Zip']
-    data['License Number'] = record['License']
-    data['Full Name'] = record['Name']
-    data['License Type'] = record['Category']
-    data['Insured'] = record['Insured']
-
-    data['Expiration Date'] = record['Expiration']
-
-    return data
+        change = lambda: util.wait_for_change(driver, elem.click, 'body')
+        if not util.browse(driver, change):
+            raise TimeoutException('Next 50 did not load for zip {}'.format(code))
+        util.served(driver)
+
+def load_zips():
+
+    df = pd.read_csv(ZIP_DATA)
+    df = df[(df.decommissioned == 0) & (df.type == 'STANDARD')]
+    df = df.rename(columns={ 'irs_estimated_population_2015': 'population' })
+    return df[['zip', 'county', 'latitude', 'longitude', 'population']] \
+            .reset_index(drop=True)
+
+def expected_rows(df, yields):
+
+    # A search only returns the plumbers of its own zip. Zips searched
+    # before keep their yield, the rest get the plumbers per head of
+    # the searched zips in their county, or of the state
+    pop = df.population.values.astype(float)
+    rows = np.array([ yields.get(str(x), {}).get('rows', np.nan) for x in df.zip ])
+
+    seen = ~np.isnan(rows)
+    if not seen.any() or not pop[seen].sum():
+        return pop
+
+    rate = np.full(len(df), rows[seen].sum() / pop[seen].sum())
+    for county, group in df[seen].groupby('county'):
+        total = group.population.sum()
+        if total:
+            rate[(df.county == county).values] = rows[group.index].sum() / total
+
+    return np.where(seen, rows, pop * rate)
+
+def plan_queries():
+
+    df = load_zips()
+    yields = util.read_json(YIELDS) or {}
+    weight = expected_rows(df, yields)
+
+    # Most plumbers first, zips known or expected to be empty are left out
+    plan = [ (int(df.zip[i]), df.county[i], float(weight[i]))
+            for i in np.argsort(-weight, kind='stable') if weight[i] > 0 ]
+
+    print('Planned', len(plan), 'zip code searches')
+    return plan
+
+def scrape_plumbers(drivers, patience=PATIENCE):
+
+    # Patience counts records new to this run, not to the store, so a
+    # rerun over a full store still covers the state
+    yields = util.read_json(YIELDS) or {}
+    seen = set()
+    idle = 0
+
+    for code, county, score in plan_queries():
+        print('Scraping Zip Code', code, county)
+        rows = new = 0
+
+        # Only a search that came back is recorded, a zero yield keeps
+        # the zip out of later plans
+        try:
+            with drivers.driver() as driver:
+                for data in scrape_plumbers_location(driver, code):
+                    rows += 1
+                    key = unique_record(data)
+                    if key in seen: continue
+                    seen.add(key)
+                    new += 1
+                    yield data
+
+        except TimeoutException as e:
+            print('Zip', code, 'failed:', e)
+            continue
+
+        print('Zip {}: {} rows, {} new, score {:.0f}, {} total'.format(
+            code, rows, new, score, len(seen)))
+
+        yields[str(code)] = { 'rows': rows, 'new': new }
+        util.replace_json(YIELDS, yields)
+
+        idle = 0 if new else idle + 1
+        if idle >= patience:
+            print('Nothing new in', patience, 'searches, stopping')
+            break
+
+def unique_record(record):
+    return (record['License'], record['Category'])
+
+def export_table(records):
+    df = util.export_frame(records, FIELDS, name='Name')
+    df['License Status'] = util.expiry_status(df['Expiration Date'], '%Y-%m-%d')
+    return df
 
 def export_csv():
-    data = util.read_json('maryland_ex.json')
-    df = pd.DataFrame([ format_record(x) for x in data ])
+    df = export_table(util.load_records(STATE, FILENAME))
     df.to_csv('./maryland.csv', index=None)
 
 def main():
 
-    driver = webdriver.Chrome()
-    results = []
-
-    for pl in scrape_plumbers(driver):
-        results.append(pl)
-        if len(results) % 200 == 0:
-            util.write_json('./maryland_ex.json', results)
-            
-    util.write_json('./maryland_ex.json', results)
+    with util.RecordStore(STATE, unique_record, FILENAME) as store:
+        for pl in scrape_plumbers(util.driver_pool()):
+            store.append(pl)
 
 if __name__ == '__main__':
     main()
-
@@ -1,15 +1,27 @@
 #!/usr/bin/env python3
 
-import pandas as pd
-import requests as rq
 import re
 import util
 
-from bs4 import BeautifulSoup
-from collections import OrderedDict
-
 URL = 'http://search.msboc.us/ConsolidatedResults.cfm'
+FILENAME = 'mississippi_ex.json'
+STATE = 'mississippi'
 KEYS = ('Type', 'Company', 'License', 'Address', 'City', 'State', 'Zip', 'Phone')
+FIELDS = {
+    'File': 'href',
+    'Company': 'Company',
+    'License Number': 'License',
+    'Street Address 1': 'Address',
+    'City': 'City',
+    'State': 'State',
+    'Zip Code': 'Zip',
+    'Phone': 'Phone',
+    'Full Name': 'Name',
+    'County': 'County',
+    'Issue Date': 'Issue',
+    'Expiration Date': 'Expiration',
+    'Fax Number': 'Fax',
+    'DBA Name': 'DBA Name' }
 
 def fetch_records_page():
 
@@ -25,13 +37,13 @@ def fetch_records_page():
         'enter_date_Begin': '', 'enter_date_end': '', 
         'qualname': '', 'startrow': 1 }
 
-    resp = rq.get(URL, params=params)
+    resp = util.client().get(URL, params=params)
     html = resp.text
     return html
 
 def parse_records_page(html):
     
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = util.soup(html)
     rows = soup.find_all('tr', class_=re.compile('^TR'))
     for tr in rows:
     	yield parse_row(tr)
@@ -50,30 +62,6 @@ def parse_row(soup):
 
     return data
 
-def format_record(record):
-
-    data = OrderedDict.fromkeys(util.COLUMNS)
-
-    data['File'] = record['href']
-    data['Company'] = record['Company']
-    data['License Number'] = record['License']
-    data['Street Address 1'] = record['Address']
-    data['City'] = record['City']
-    data['State'] = record['State']
-    data['Zip Code'] = record['Zip']
-    data['Phone'] = record['Phone']
-
-    data['Full Name'] = record['Name']
-    data['County'] = record['County']
-
-    data['Issue Date'] = record['Issue']
-    data['Expiration Date'] = record['Expiration']
-
-    data['Fax Number'] = record['Fax']
-    data['DBA Name'] = record['DBA Name']
-
-    return data
-
 def scrape_plumbers():
     html = fetch_records_page()
     yield from parse_records_page(html)
@@ -87,10 +75,10 @@ def scrape_details(record):
     
     url = record['href']
 
-    resp = rq.get(url)
+    resp = util.client().get(url)
     html = resp.text
 
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = util.soup(html)
 
     elem = soup.find('td', string='Miss. County')
     record['County'] = next_td_text(elem)
@@ -115,24 +103,20 @@ def scrape_details(record):
 def unique_record(record):
     return tuple( record[k] for k in KEYS )
 
+def export_table(records):
+    return util.export_frame(records, FIELDS)
+
 def export_csv():
-    data = util.read_json('mississippi_ex.json')
-    df = pd.DataFrame([ format_record(x) for x in data ])
+    df = export_table(util.load_records(STATE, FILENAME))
     df.to_csv('mississippi.csv', index=None)
 
 def main():
-    filename = 'mississippi_ex.json'
-    results = util.read_json(filename)
-    scraped = set( unique_record(x) for x in results )
-    for record in scrape_plumbers():
-        if unique_record(record) not in scraped:
-            print('Scraping details', record['License'])
-            details = scrape_details(record)
-            results.append(details)
-            util.write_json(filename, results)
-        else:
-            print('Already scraped', record['License'])
-    util.write_json(filename, results)
+
+    with util.RecordStore(STATE, unique_record, FILENAME) as store:
+        records = scrape_plumbers()
+        for details in util.fetch_details(records, scrape_details, store):
+            print('Scraped details', details['License'])
+            store.append(details)
 
 if __name__ == '__main__':
     main()
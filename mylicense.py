@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+
+# Plain HTTP driver for the MyLicense Search.aspx / datagrid_results
+# portals (Delaware, Georgia, Indiana, New Hampshire, New Jersey)
+
+import requests as rq
+import re
+import functools
+import util
+
+from urllib.parse import urljoin
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support.ui import Select
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException, NoSuchElementException
+
+POSTBACK = re.compile(r"__doPostBack\('([^']*)','([^']*)'\)")
+RESULTS = '#datagrid_results'
+NEXT = '//table[@id="datagrid_results"]//tr[last()]//span/following-sibling::a'
+
+# Sessions paging through one search at once
+SHARDS = 4
+
+def form_fields(soup):
+
+    # What the browser would send on submit, minus the buttons
+    data = dict()
+    form = soup.find('form')
+
+    for elem in form.find_all('input'):
+        name = elem.get('name')
+        kind = elem.get('type', 'text').lower()
+        if name is None or kind in ('submit', 'button', 'image'):
+            continue
+        if kind in ('checkbox', 'radio') and not elem.has_attr('checked'):
+            continue
+        data[name] = elem.get('value', '')
+
+    for elem in form.find_all('select'):
+        name = elem.get('name')
+        if name is None: continue
+        opt = elem.find('option', selected=True) or elem.find('option')
+        data[name] = opt.get('value', '') if opt else ''
+
+    return data
+
+def form_action(url, soup):
+    form = soup.find('form')
+    return urljoin(url, form.get('action') or url)
+
+def postback(session, url, soup, target, argument='', fields=None):
+
+    payload = form_fields(soup)
+    payload.update(fields or {})
+    payload['__EVENTTARGET'] = target
+    payload['__EVENTARGUMENT'] = argument
+
+    return session.post(form_action(url, soup), data=payload)
+
+def search(session, url, fields):
+
+    resp = session.get(url)
+    resp.raise_for_status()
+
+    # Selects with AutoPostBack repopulate the form (e.g. profession
+    # fills the license types), so replay them in order
+    for name, value in fields.items():
+        soup = util.soup(resp.text)
+        elem = soup.find('select', attrs={ 'name': name })
+        if elem is None: continue
+        if '__doPostBack' not in elem.get('onchange', ''): continue
+        resp = postback(session, resp.url, soup, name, fields={ name: value })
+
+    soup = util.soup(resp.text)
+    payload = form_fields(soup)
+    payload.update(fields)
+    payload['sch_button'] = 'Search'
+
+    resp = session.post(form_action(resp.url, soup), data=payload)
+    resp.raise_for_status()
+    return resp
+
+def pager(soup):
+    table = soup.find('table', id='datagrid_results')
+    if table is None: return
+    body = table.tbody or table
+    rows = body.find_all('tr', recursive=False)
+    return rows[-1] if rows else None
+
+def next_page(soup):
+
+    # The current page is a <span>, the link right after it is
+    # either the next page or the "..." of the next block
+    row = pager(soup)
+    current = row.find('span') if row else None
+    if current is None: return
+
+    for anchor in current.find_next_siblings('a'):
+        match = POSTBACK.search(anchor.get('href', ''))
+        if match: return match.groups()
+
+def current_page(soup):
+    row = pager(soup)
+    span = row.find('span') if row else None
+    return int(span.get_text(strip=True)) if span else 1
+
+def page_links(soup):
+
+    # Page number -> postback of the numbered links in the pager
+    links = dict()
+    row = pager(soup)
+
+    for anchor in row.find_all('a') if row else []:
+        text = anchor.get_text(strip=True)
+        match = POSTBACK.search(anchor.get('href', ''))
+        if match and text.isdigit():
+            links[int(text)] = match.groups()
+
+    return links
+
+def next_block(soup):
+
+    # The "..." after the current page opens the next block of links
+    row = pager(soup)
+    current = row.find('span') if row else None
+    if current is None: return
+
+    for anchor in current.find_next_siblings('a'):
+        if anchor.get_text(strip=True) != '...': continue
+        match = POSTBACK.search(anchor.get('href', ''))
+        if match: return match.groups()
+
+def page_blocks(session, url, fields):
+
+    # Only the last block shows the last page, so hop block to block,
+    # keeping the first page of each
+    resp = search(session, url, fields)
+    blocks = [ (resp.url, resp.text) ]
+
+    while True:
+        soup = util.soup(resp.text)
+        target = next_block(soup)
+        if target is None: break
+        resp = postback(session, resp.url, soup, *target)
+        resp.raise_for_status()
+        blocks.append((resp.url, resp.text))
+
+    return blocks
+
+def page_count(blocks):
+    soup = util.soup(blocks[-1][1])
+    return max([ current_page(soup) ] + list(page_links(soup)))
+
+def jump_page(session, url, soup, target, argument, page, page_of=current_page):
+
+    # One postback straight to page, checked against where it landed
+    resp = postback(session, url, soup, target, argument)
+    resp.raise_for_status()
+
+    landed = page_of(util.soup(resp.text))
+    if landed != page:
+        raise ValueError('Asked for page {}, landed on {}'.format(page, landed))
+    return resp
+
+def jump(session, blocks, page):
+
+    # The datagrid pager posts control ids, not Page$N, and only the
+    # links of the block on screen exist. The saved block pages carry
+    # their view state, so page is one postback from the block holding
+    # its link. Block starts are reached from the block before
+    for (url, html), (_, after) in zip(blocks, blocks[1:] + [ (None, None) ]):
+        soup = util.soup(html)
+        target = page_links(soup).get(page)
+        if target is None and after is not None \
+                and current_page(util.soup(after)) == page:
+            target = next_block(soup)
+        if target is not None:
+            return jump_page(session, url, soup, *target, page)
+
+    raise ValueError('Page {} not found'.format(page))
+
+def seek(session, resp, page):
+
+    # From any page forward to page, a block at a time
+    while True:
+        soup = util.soup(resp.text)
+        if current_page(soup) == page:
+            return resp
+
+        target = page_links(soup).get(page) or next_block(soup)
+        if target is None:
+            raise ValueError('Page {} not found'.format(page))
+
+        resp = postback(session, resp.url, soup, *target)
+        resp.raise_for_status()
+
+def start_shard(session, url, fields, start, blocks):
+
+    # The shard's own search gives it its own ASP.NET_SessionId, the
+    # portal serializes requests sharing one. The jump posts the saved
+    # block pages' view state from this session; where the portal ties
+    # view state to the session it misses, and the shard walks instead
+    resp = search(session, url, fields)
+
+    if start > 1 and blocks:
+        try:
+            return jump(session, blocks, start)
+        except (ValueError, rq.RequestException) as e:
+            print('Jump to page', start, 'failed:', e, '- walking there instead')
+
+    return seek(session, resp, start)
+
+def scrape_shard(url, fields, start, stop=None, blocks=None):
+
+    # Own session, so the portal serves the shards in parallel
+    session = util.Client(cache=util.client().cache)
+    resp = start_shard(session, url, fields, start, blocks)
+    page = start
+
+    while True:
+        print('Fetched page', page)
+        yield resp.text
+
+        page += 1
+        if stop is not None and page >= stop: break
+
+        soup = util.soup(resp.text)
+        target = next_page(soup)
+        if target is None:
+            if stop is not None:
+                print('Pages end at', page - 1, 'before', stop - 1)
+            break
+
+        resp = postback(session, resp.url, soup, *target)
+        resp.raise_for_status()
+
+def scrape_sharded(session, url, fields, shards=SHARDS):
+
+    blocks = page_blocks(session, url, fields)
+    count = page_count(blocks)
+    print('Found', count, 'pages')
+
+    fetch = lambda start, stop: scrape_shard(url, fields, start, stop, blocks)
+    return util.sharded(count, shards, fetch)
+
+def scrape_pages(session, url, fields):
+
+    resp = search(session, url, fields)
+    page = 1
+
+    while True:
+        print('Fetched page', page)
+        yield resp.text
+
+        soup = util.soup(resp.text)
+        target = next_page(soup)
+        if target is None: break
+
+        resp = postback(session, resp.url, soup, *target)
+        resp.raise_for_status()
+        page += 1
+
+def extract_details(html, ids):
+
+    data = dict()
+    soup = util.soup(html)
+
+    for k, id_ in ids.items():
+        elem = soup.find(id=id_)
+        data[k] = elem.get_text(strip=True) if elem else None
+
+    return data
+
+def scrape_details(session, record, ids):
+
+    resp = session.get(record['href'])
+    record.update(extract_details(resp.text, ids))
+    return record
+
+# Same steps in a browser, each waiting for the postback it causes
+
+def wait_for_elem(driver, query, timeout=20):
+    event = EC.element_to_be_clickable((By.CSS_SELECTOR, query))
+    wait = WebDriverWait(driver, timeout)
+    return wait.until(event)
+
+def browser_search(driver, url, fields):
+
+    driver.get(url)
+
+    for name, value in fields.items():
+        elem = wait_for_elem(driver, 'select[name="{}"]'.format(name))
+        select = lambda: Select(elem).select_by_value(value)
+        if '__doPostBack' in (elem.get_attribute('onchange') or ''):
+            util.wait_for_change(driver, select, 'form')
+        else:
+            select()
+
+    elem = wait_for_elem(driver, 'input[name="sch_button"]')
+    if not util.wait_for_change(driver, elem.click, RESULTS):
+        raise TimeoutException('No search results')
+
+def browser_page(driver, page):
+
+    query = '//table[@id="datagrid_results"]//a[text()={}]'
+
+    try:
+        elem = driver.find_element_by_xpath(query.format(page))
+    except NoSuchElementException:
+        print('Button not found, moving on ...')
+        elem = driver.find_elements_by_xpath(query.format('"..."'))[-1]
+
+    if not util.wait_for_change(driver, elem.click, RESULTS):
+        raise TimeoutException('Page {} did not load'.format(page))
+
+def browser_jump(driver, target, argument, page, query=RESULTS, page_of=current_page):
+
+    # Same postback the pager link would fire, without finding the link
+    post = lambda: driver.execute_script(
+            '__doPostBack(arguments[0], arguments[1]);', target, argument)
+    if not util.wait_for_change(driver, post, query):
+        raise TimeoutException('Page {} did not load'.format(page))
+
+    landed = page_of(util.soup(driver.page_source))
+    if landed != page:
+        raise ValueError('Asked for page {}, landed on {}'.format(page, landed))
+
+def browser_next(driver, key):
+
+    # Replays read the pager off the snapshot, the browser never moved
+    cache = util.client().cache
+    if cache is not None and cache.replay:
+        return next_page(util.soup(util.snapshot(driver, key))) is not None
+    return bool(driver.find_elements_by_xpath(NEXT))
+
+def browser_rows(driver, cells=':scope > td'):
+
+    # Result rows without the header and the pager
+    rows = util.table_rows(driver, RESULTS, cells=cells)
+    return rows[1:-1] if rows else []
+
+# One state's portal, all the states differ in is the search, the
+# detail page ids, the listing columns and the export fields
+
+class Portal:
+
+    def __init__(self, url, filename, state, keys, search, details, fields):
+        self.url = url
+        self.filename = filename
+        self.state = state
+        self.keys = keys
+        self.search = search
+        self.details = details
+        self.fields = fields
+
+    def make_record(self, cols, anchor):
+        data = dict.fromkeys(self.keys)
+        data.update(zip(self.keys, cols))
+        data['href'] = urljoin(self.url, anchor['href'])
+        return data
+
+    def parse_row(self, soup):
+        cols = [ td.get_text(strip=True) for td in soup.find_all('td', recursive=False) ]
+        return self.make_record(cols, soup.find('a'))
+
+    def extract_plumbers(self, html):
+
+        soup = util.soup(html)
+        elem = soup.find('table', id='datagrid_results')
+        body = elem.tbody or elem
+        rows = body.find_all('tr', recursive=False)
+
+        for row in rows[1:-1]:
+            yield self.parse_row(row)
+
+    def browser_plumbers(self, driver):
+        for row in browser_rows(driver):
+            yield self.make_record(row['cells'], row['anchors'][0])
+
+    def scrape_plumbers(self, driver):
+
+        navigate = functools.partial(browser_search, driver, self.url, self.search)
+        yield from util.page_rows(driver, (self.url, 1), navigate,
+                self.extract_plumbers, self.browser_plumbers)
+
+        p = 2
+        while browser_next(driver, (self.url, p - 1)):
+            print('Clicking page', p)
+            navigate = functools.partial(browser_page, driver, p)
+            yield from util.page_rows(driver, (self.url, p), navigate,
+                    self.extract_plumbers, self.browser_plumbers)
+            p += 1
+
+    def fetch_plumbers(self, session):
+        for html in scrape_sharded(session, self.url, self.search):
+            yield from self.extract_plumbers(html)
+
+    def scrape_details(self, session, record):
+
+        # A broken detail page keeps the listing row
+        try:
+            scrape_details(session, record, self.details)
+        except Exception as e:
+            print('Error extracting details for', record['License'], e)
+
+        return record
+
+    def unique_record(self, record):
+        return tuple( record[k] for k in self.keys )
+
+    def export_table(self, records):
+        return util.export_frame(records, self.fields, name='Name')
+
+    def export_csv(self):
+        df = self.export_table(util.load_records(self.state, self.filename))
+        df.to_csv('./{}.csv'.format(self.state), index=None)
+
+    def main(self):
+        session = util.client()
+        scrape = functools.partial(self.scrape_details, session)
+
+        with util.RecordStore(self.state, self.unique_record, self.filename) as store:
+            records = self.fetch_plumbers(session)
+            for details in util.fetch_details(records, scrape, store):
+                print('Scraped details', details['License'])
+                store.append(details)
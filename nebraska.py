@@ -1,16 +1,30 @@
 #!/usr/bin/env python3
 
-import requests as rq
-import pandas as pd
 import util
 
-from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.support.ui import Select
-from collections import OrderedDict
 
 URL = 'https://dol.nebraska.gov/conreg/Search'
+FILENAME = 'nebraska_ex.json'
+STATE = 'nebraska'
 KEYS = ( 'Option', 'Registered', 'Expires' )
+FIELDS = {
+    'File': 'href',
+    'Company': 'Company',
+    'Street Address 1': 'Address',
+    'Certificate Expires': 'Expires',
+    'Certificate Registered': 'Registered',
+    'Contractor Name': 'Contractor',
+    'Corporation Name': 'Corporation',
+    'Entity': 'Entity',
+    'City': 'City',
+    'State': 'State',
+    'Zip Code': 'Zip',
+    'Phone': 'Phone',
+    'Registration Number': 'Registration Number',
+    'Employees': 'Employees',
+    'Worker Compensation Status': 'Worker Compensation Status' }
 
 def prepare_scrape(driver: webdriver.Chrome):
 
@@ -35,7 +49,7 @@ def scrape_plumbers(driver):
 
 def extract_plumbers(html):
 
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = util.soup(html)
     rows = soup.find_all('tr', class_='fieldset-outline')
 
     for tr in rows:
@@ -61,34 +75,17 @@ def parse_row(soup):
 
     return data
 
-def format_record(record):
-
-    data = OrderedDict.fromkeys(util.COLUMNS)
-    address = record['Address'].split('. ')
-
-    data['File'] = record['href']
-    data['Company'] = record['Company']
-    data['Street Address 1'] = address[0]
-    data['Street Address 2'] = address[1]
-    data['Certificate Expires'] = record['Expires']
-    data['Certificate Registered'] = record['Registered']
-
-    data['Contractor Name'] = record.get('Contractor', '')
-    data['Corporation Name'] = record.get('Corporation', '')
-    data['Entity'] = record.get('Entity', '')
-    data['City'] = record.get('City', '')
-    data['State'] = record.get('State', '')
-    data['Zip Code'] = record.get('Zip', '')
-    data['Phone'] = record.get('Phone', '')
-    data['Registration Number'] = record.get('Registration Number', '')
-    data['Employees'] = record.get('Employees', '')
-    data['Worker Compensation Status'] = record.get('Worker Compensation Status', '')
+def export_table(records):
+    df = util.export_frame(records, FIELDS)
 
-    return data
+    address = df['Street Address 1'].str.split('. ', regex=False)
+    df['Street Address 1'] = address.str[0]
+    df['Street Address 2'] = address.str[1]
+
+    return df
 
 def export_csv():
-    data = util.read_json('nebraska_ex.json')
-    df = pd.DataFrame([ format_record(x) for x in data ])
+    df = export_table(util.load_records(STATE, FILENAME))
     df.to_csv('./nebraska.csv', index=None)
 
 def scrape_details(record):
@@ -96,7 +93,7 @@ def scrape_details(record):
     url = record['href']
 
     try:
-        resp = rq.get(url)
+        resp = util.client().get(url)
         resp.raise_for_status()
 
     except Exception:
@@ -104,7 +101,7 @@ def scrape_details(record):
 
     html = resp.text
 
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = util.soup(html)
     rows = soup.select('#printPage table td')
     
     record['Contractor'] = rows[0].get_text(strip=True)
@@ -128,23 +125,12 @@ def main():
     # driver = webdriver.Chrome()
     # prepare_scrape(driver)
 
-    filename = 'nebraska_ex.json'
     records = util.read_json('./nebraska.json')
-    results = util.read_json(filename)
-    scraped = set( unique_record(x) for x in results )
-
-    for pl in records:
-
-        if unique_record(pl) in scraped: 
-            print('Already scraped', pl['Company'])
-            continue
-
-        print('Scraping details', pl['Company'])
-        details = scrape_details(pl)
-        results.append(details)
-        util.write_json(filename, results)
 
-    util.write_json(filename, results)
+    with util.RecordStore(STATE, unique_record, FILENAME) as store:
+        for details in util.fetch_details(records, scrape_details, store):
+            print('Scraped details', details['Company'])
+            store.append(details)
 
 if __name__ == '__main__':
     main()
@@ -1,19 +1,35 @@
 #!/usr/bin/env python3
 
-import pandas as pd
-import requests as rq
+import functools
+import mylicense
 import util
 import re
 
-from bs4 import BeautifulSoup
-from collections import OrderedDict
-
-from selenium import webdriver
 from selenium.webdriver.support.ui import Select
-from selenium.common.exceptions import NoSuchElementException
 
 URL = 'https://dltweb.dlt.ri.gov/profregsonline/LicenseSearch'
 FILENAME = 'rhodeisland.json'
+STATE = 'rhodeisland'
+FIELDS = {
+    'Name': 'Name',
+    'Street Address 1': 'Address',
+    'Phone': 'Home Phone',
+    'Business Phone': 'Business Phone',
+    'Company': 'Company',
+    'License Number': 'License',
+    'License Status': 'Status',
+    'License Code': 'Code',
+    'Issue Date': 'Issue',
+    'Expiration Date': 'Expiration Date',
+    'Insurance Name': 'Insurance Name',
+    'Insurance Termination date': 'Insurance Termination Date' }
+
+GRID = 'MainContent_gvLicenseSearchResults'
+ROW_ID = re.compile(r'^MainContent_gvLicenseSearchResults_lbLicenseDetails_')
+
+# Detail labels, each followed by its value in a <span>
+LABELS = [ 'Name', 'Address', 'Home Phone', 'Business Phone', 'Company',
+        'Expiration Date', 'Insurance Name', 'Insurance Termination Date' ]
 
 def prepare_scrape(driver):
 
@@ -37,44 +53,30 @@ def click_plumber(driver, index):
 
 def click_page(driver, page):
 
-    try:
-        path = '//a[text()="{}"]'.format(page)
-        elem = driver.find_element_by_xpath(path)
-        elem.click()
-
-    except NoSuchElementException:
-        query = '#MainContent_gvLicenseSearchResults table a'
-        elems = driver.find_elements_by_css_selector(query)
+    # The grid pages on Page$N postbacks, so any page is one jump away
+    soup = util.soup(driver.page_source)
+    mylicense.browser_jump(driver, grid_target(soup), page_argument(page),
+            page, '#' + GRID, current_page)
 
-        # click next pages button
-        label = elems[-1].get_property('innerText')
-        if label == '...': 
-            elems[-1].click()
+def field_values(soup):
 
-def find_field_value(soup, field):
+    # Every label in one pass, the first occurrence wins
+    values = dict()
+    for elem in soup.find_all(string=LABELS):
+        if elem in values: continue
+        div = elem.find_parent('div')
+        span = div.span if div else None
+        values[str(elem)] = span.get_text(strip=True) if span else ''
 
-    elem = soup.find(string=field)
-    if elem is None: return ''
-    span = elem.find_parent('div').span
-    return span.get_text(strip=True)
+    return values
 
-def extract_details(driver):
+def extract_details(html):
 
-    data = dict()
     keys = [ 'License', 'Status', 'Code', 'Issue' ]
+    soup = util.soup(html)
 
-    html = driver.page_source
-    soup = BeautifulSoup(html, 'html.parser')
-
-    data['Name'] = find_field_value(soup, 'Name')
-    data['Address'] = find_field_value(soup, 'Address')
-    data['Home Phone'] = find_field_value(soup, 'Home Phone')
-    data['Business Phone'] = find_field_value(soup, 'Business Phone')
-    data['Company'] = find_field_value(soup, 'Company')
-    data['Expiration Date'] = find_field_value(soup, 'Expiration Date')
-    data['Insurance Name'] = find_field_value(soup, 'Insurance Name')
-    data['Insurance Termination Date'] = \
-            find_field_value(soup, 'Insurance Termination Date')
+    values = field_values(soup)
+    data = { k: values.get(k, '') for k in LABELS }
 
     elem = soup.find(id='MainContent_gvLicenses')
     cols = elem.find_all('td')
@@ -84,79 +86,150 @@ def extract_details(driver):
 
     return data
 
-def pl_license(driver, index):
-
-    html = driver.page_source
-    soup = BeautifulSoup(html, 'html.parser')
+def result_rows(soup):
 
-    id_ = r'^MainContent_gvLicenseSearchResults_lbLicenseDetails_'
-    elem = soup.find_all(id=re.compile(id_))
+    # License number and postback target of every row on the page
+    rows = []
+    for elem in soup.find_all(id=ROW_ID):
+        match = mylicense.POSTBACK.search(elem.get('href', ''))
+        target = match.group(1) if match else None
+        rows.append((elem.get_text(strip=True), target))
 
-    return elem[index].get_text(strip=True)
+    return rows
 
 def scrape_current_page(driver, scraped):
 
-    for index in range(8):
-        pl = pl_license(driver, index)
+    soup = util.soup(driver.page_source)
+
+    for index, (pl, _) in enumerate(result_rows(soup)):
         if pl in scraped:
             print('Already scraped', pl)
             continue
 
         click_plumber(driver, index)
-        yield extract_details(driver)
-
-def scrape_plumbers(driver):
+        yield extract_details(driver.page_source)
 
-    records = util.read_json(FILENAME)
-    scraped = set( x['License'] for x in records )
+def scrape_plumbers(driver, scraped):
 
     for p in range(2, 259):
         yield from scrape_current_page(driver, scraped)
         print('Clicking page', p)
         click_page(driver, p)
 
-def format_record(record):
+def search(session):
 
-    data = OrderedDict.fromkeys(util.COLUMNS)
+    resp = session.get(URL)
+    resp.raise_for_status()
+    soup = util.soup(resp.text)
 
-    data['Name'] = record['Name']
-    data['Street Address 1'] = record['Address']
+    select = soup.find(id='MainContent_cboTrade')
+    fields = { select['name']: 'Plumber' }
 
-    data['Phone'] = record['Home Phone']
-    data['Business Phone'] = record['Business Phone']
+    if '__doPostBack' in select.get('onchange', ''):
+        resp = mylicense.postback(session, resp.url, soup, select['name'], fields=fields)
+        resp.raise_for_status()
+        soup = util.soup(resp.text)
 
-    data['Company'] = record['Company']
+    button = soup.find(id='MainContent_btnSearch')
+    payload = mylicense.form_fields(soup)
+    payload.update(fields)
+    payload[button['name']] = button.get('value', '')
 
-    data['License Number'] = record['License']
-    data['License Status'] = record['Status']
-    data['License Code'] = record['Code']
+    resp = session.post(mylicense.form_action(resp.url, soup), data=payload)
+    resp.raise_for_status()
+    return resp
 
-    data['Issue Date'] = record['Issue']
-    data['Expiration Date'] = record['Expiration Date']
+def page_argument(page):
+    return 'Page${}'.format(page)
 
-    data['Insurance Name'] = record['Insurance Name']
-    data['Insurance Termination date'] = \
-            record['Insurance Termination Date']
-    
-    return data
+def grid_target(soup):
+
+    # Unique id of the grid, what its pager links post back to
+    grid = soup.find(id=GRID)
+    for anchor in grid.find_all('a') if grid else []:
+        match = mylicense.POSTBACK.search(anchor.get('href', ''))
+        if match and match.group(2).startswith('Page$'):
+            return match.group(1)
+
+def current_page(soup):
+
+    # The pager is the table nested in the grid, the current page a <span>
+    grid = soup.find(id=GRID)
+    pager = grid.find('table') if grid else None
+    span = pager.find('span') if pager else None
+    return int(span.get_text(strip=True)) if span else 1
+
+def next_page(soup, page):
+
+    # Either the page number or the "..." that opens the next block
+    grid = soup.find(id=GRID)
+    argument = page_argument(page + 1)
+
+    for anchor in grid.find_all('a') if grid else []:
+        match = mylicense.POSTBACK.search(anchor.get('href', ''))
+        if match and match.group(2) == argument:
+            return match.groups()
+
+def fetch_pages(session, start=1):
+
+    resp = search(session)
+    page = start
+
+    if start > 1:
+        soup = util.soup(resp.text)
+        resp = mylicense.jump_page(session, resp.url, soup, grid_target(soup),
+                page_argument(start), start, current_page)
+
+    while True:
+        print('Fetched page', page)
+        soup = util.soup(resp.text)
+        yield resp.url, soup
+
+        target = next_page(soup, page)
+        if target is None: break
+
+        resp = mylicense.postback(session, resp.url, soup, *target)
+        resp.raise_for_status()
+        page += 1
+
+def fetch_plumbers(session):
+
+    # Rows carry the form of their page, details are postbacks from it
+    for url, soup in fetch_pages(session):
+        form = mylicense.form_action(url, soup), mylicense.form_fields(soup)
+        for pl, target in result_rows(soup):
+            yield { 'License': pl, '_target': target, '_form': form }
+
+def scrape_details(session, record):
+
+    action, fields = record['_form']
+    payload = dict(fields)
+    payload['__EVENTTARGET'] = record['_target']
+    payload['__EVENTARGUMENT'] = ''
+
+    resp = session.post(action, data=payload)
+    resp.raise_for_status()
+    return extract_details(resp.text)
+
+def unique_record(record):
+    return record['License']
+
+def export_table(records):
+    return util.export_frame(records, FIELDS)
 
 def export_csv():
-    data = util.read_json('rhodeisland.json')
-    df = pd.DataFrame([ format_record(x) for x in data ])
+    df = export_table(util.load_records(STATE, FILENAME))
     df.to_csv('./rhodeisland.csv', index=None)
 
 def main():
+    session = util.client()
+    scrape = functools.partial(scrape_details, session)
 
-    driver = webdriver.Chrome()
-    prepare_scrape(driver)
-
-    results = util.read_json(FILENAME)
-
-    for pl in scrape_plumbers(driver):
-        print(pl['License'])
-        results.append(pl)
-        util.write_json(FILENAME, results)
+    with util.RecordStore(STATE, unique_record, FILENAME) as store:
+        records = fetch_plumbers(session)
+        for pl in util.fetch_details(records, scrape, store):
+            print(pl['License'])
+            store.append(pl)
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Run several states at once, each in its own process
+#
+#   python runner.py                     # every state
+#   python runner.py georgia kentucky --browsers 2 --jobs 8
+
+import sys
+import time
+import argparse
+import importlib
+import traceback
+import util
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Browser states share a smaller pool, Chrome is the heavy part
+STATES = {
+    'delaware': 'http',
+    'georgia': 'http',
+    'indiana': 'http',
+    'iowa': 'browser',
+    'kentucky': 'http',
+    'maryland': 'browser',
+    'mississippi': 'http',
+    'nebraska': 'http',
+    'newhamshire': 'http',
+    'newjersey': 'http',
+    'rhodeisland': 'http',
+    'texas': 'browser',
+    'utah': 'http',
+    'westvirginia': 'http',
+}
+
+def count_records(module):
+    with util.RecordStore(module.STATE) as store:
+        return len(store)
+
+def run_state(state):
+
+    # Runs in the worker process
+    module = importlib.import_module(state)
+    before = count_records(module)
+    start = time.time()
+    error = None
+
+    try:
+        module.main()
+    except BaseException:
+        error = traceback.format_exc()
+
+    pools = util.client().stats().values()
+    return {
+        'state': state,
+        'seconds': time.time() - start,
+        'records': count_records(module) - before,
+        'requests': sum( x['requests'] for x in pools ),
+        'connections': sum( x['connections'] for x in pools ),
+        'error': error }
+
+def run_states(states, browsers=2, jobs=8):
+
+    # One state per process so client stats and module state start clean
+    results = []
+    pools = {
+        'browser': ProcessPoolExecutor(max_workers=browsers, max_tasks_per_child=1),
+        'http': ProcessPoolExecutor(max_workers=jobs, max_tasks_per_child=1) }
+
+    try:
+        futures = { pools[STATES[x]].submit(run_state, x): x for x in states }
+        for fut in as_completed(futures):
+            try:
+                result = fut.result()
+            except Exception:
+                result = {
+                    'state': futures[fut], 'seconds': 0, 'records': 0,
+                    'requests': 0, 'connections': 0,
+                    'error': traceback.format_exc() }
+
+            status = 'failed' if result['error'] else 'done'
+            print('[{}] {} in {:.0f}s'.format(result['state'], status, result['seconds']))
+            results.append(result)
+
+    finally:
+        for pool in pools.values():
+            pool.shutdown()
+
+    return sorted(results, key=lambda x: x['state'])
+
+def print_summary(results, elapsed):
+
+    print()
+    print('{:14} {:>8} {:>10} {:>10} {:>10} {:>8}  {}'.format(
+        'state', 'records', 'seconds', 'rec/sec', 'requests', 'conns', 'status'))
+
+    for x in results:
+        rate = x['records'] / x['seconds'] if x['seconds'] else 0
+        status = 'FAILED' if x['error'] else 'ok'
+        print('{:14} {:>8} {:>10.0f} {:>10.1f} {:>10} {:>8}  {}'.format(
+            x['state'], x['records'], x['seconds'], rate,
+            x['requests'], x['connections'], status))
+
+    total = sum( x['records'] for x in results )
+    failed = [ x for x in results if x['error'] ]
+    print('Total {} records in {:.0f}s, {} failed'.format(total, elapsed, len(failed)))
+
+    for x in failed:
+        print()
+        print('---', x['state'])
+        print(x['error'])
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('states', nargs='*', help='states to run, all by default')
+    parser.add_argument('--browsers', type=int, default=2,
+            help='browser states running at once')
+    parser.add_argument('--jobs', type=int, default=8,
+            help='HTTP only states running at once')
+    args = parser.parse_args()
+
+    unknown = set(args.states) - set(STATES)
+    if unknown:
+        parser.error('unknown states: ' + ', '.join(sorted(unknown)))
+
+    start = time.time()
+    results = run_states(args.states or list(STATES), args.browsers, args.jobs)
+    print_summary(results, time.time() - start)
+
+    if any( x['error'] for x in results ):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
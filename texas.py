@@ -3,20 +3,70 @@
 # 23 Journeyman Plumber
 # 24 Master Plumber
 
-# Last 48439
-
-import re
+import os
+import queue
+import threading
 import util
-import nameparser
 
-from bs4 import BeautifulSoup
-from collections import OrderedDict
-from selenium import webdriver
+from concurrent.futures import ThreadPoolExecutor
 from selenium.webdriver.support.ui import Select
 from selenium.common.exceptions import NoSuchElementException
 
 URL = 'https://vo.licensing.hpc.texas.gov/datamart/selSearchType.do'
 FILENAME = 'texas_ex.json'
+STATE = 'texas'
+CURSOR = 'texas_cursor.json'
+
+# Journeyman and Master are separate searches
+RANKS = ( '24', '23' )
+PAGE_SIZE = '10'
+
+# Browsers working the county queue
+WORKERS = 4
+RETRIES = 2
+
+LOCK = threading.Lock()
+
+FIELDS = {
+    'License Number': 'License',
+    'License Status': 'Status',
+    'Street Address 1': 'Address',
+    'Phone': 'Phone',
+    'Full Name': 'Name',
+    'License Type': 'Type',
+    'Expiration Date': 'Expiration',
+    'Certification of Insurance': 'Certification of Insurance' }
+
+# Cells of a result row, in order
+LISTING_KEYS = [ 'Name', 'License', 'Type' ]
+
+# In-page counterparts of parse_counties, extract_listing and
+# parse_details for PLUMBER_EXTRACT=browser
+JS_COUNTIES = '''
+var elem = document.querySelector('[name="countyAgencyKey"]');
+return Array.prototype.map.call(elem.querySelectorAll('option'),
+    function (opt) { return opt.getAttribute('value'); });
+'''
+
+JS_LISTING = util.JS_TEXT + '''
+return Array.prototype.map.call(document.querySelectorAll('span.item a'),
+    function (a) {
+        var tr = a.closest('tr');
+        return { name: text(a), cells: tr ? row(tr, 'td').cells : [] };
+    });
+'''
+
+JS_DETAILS = util.JS_TEXT + '''
+var map = Array.prototype.map;
+var license = document.querySelector('input[name="licNumber"]');
+return {
+    license: license.getAttribute('value'),
+    values: map.call(document.querySelectorAll('td.dataView'),
+        function (td) { return text(td); }),
+    tables: map.call(document.querySelectorAll('span.item table'),
+        function (table) { return text(table, ', '); })
+};
+'''
 
 def prepare_scrape(driver):
 
@@ -40,179 +90,285 @@ def select_by_name(driver, name, value):
     elem.select_by_value(value)
 
 def county_options(driver):
+    return util.read_page(driver, parse_counties, browser_counties)
+
+def parse_counties(html):
 
-    html = driver.page_source
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = util.soup(html)
 
     elem = soup.find(attrs={ 'name': 'countyAgencyKey' })
     opts = elem.find_all('option')
 
     return [ x['value'] for x in opts if x['value'] ]
 
-def page_state(driver):
+def browser_counties(driver):
+    return [ x for x in driver.execute_script(JS_COUNTIES) if x ]
 
-    html = driver.page_source
-    soup = BeautifulSoup(html, 'html.parser')
+def click(driver, elem):
 
-    elems = soup.select('form[name="BaseForm"] tr td b > a')
-    return tuple( a.get_text(strip=True) for a in elems )
+    # True once the page text changed, False if it came back the same
+    change = lambda: util.wait_for_change(driver, elem.click, 'body')
+    return util.browse(driver, change)
 
 def click_next_page(driver):
 
     try:
-        prev = page_state(driver)
-        print('Clicking next page')
-
         elem = driver.find_element_by_name('nextPage')
-        elem.click()
-
-        now = page_state(driver)
-        return now != prev
-
     except NoSuchElementException:
         return False
 
+    print('Clicking next page')
+    return click(driver, elem)
+
 def click_next_record(driver):
 
     try:
         elem = driver.find_element_by_name('nextRow')
-        elem.click()
-        return True
+        return click(driver, elem)
 
     except NoSuchElementException:
         return False
 
-def scrape_county(driver, ct):
+def new_criteria(driver):
+
+    for name in ('newcriteria', 'back'):
+        try:
+            elem = driver.find_element_by_name(name)
+            click(driver, elem)
+            return
+        except NoSuchElementException:
+            continue
+
+def search_county(driver, ct):
 
-    print('Scraping county', ct)
     select_by_name(driver, 'countyAgencyKey', ct)
 
     # Click search
     elem = driver.find_element_by_name('search')
-    elem.click()
+    click(driver, elem)
 
-    try:
-        # Click first plumber
-        elem = driver.find_element_by_css_selector('span.item a')
-        elem.click()
-
-    except NoSuchElementException: 
-        # If there is no plumbers go back
-        elem = driver.find_element_by_name('back')
-        elem.click()
-        return
+    if driver.find_elements_by_css_selector('span.item a'):
+        return True
+
+    # If there is no plumbers go back
+    new_criteria(driver)
+    return False
+
+def listing_record(index, name, cols):
+    data = dict.fromkeys(LISTING_KEYS, '')
+    data.update(zip(LISTING_KEYS, cols))
+    data['Name'] = name
+    data['_index'] = index
+    return data
 
+def extract_listing(html):
+
+    soup = util.soup(html)
+    anchors = soup.select('span.item a')
+
+    for index, anchor in enumerate(anchors):
+        row = anchor.find_parent('tr')
+        cols = [ td.get_text(strip=True) for td in row.find_all('td') ] if row else []
+        yield listing_record(index, anchor.get_text(strip=True), cols)
+
+def browser_listing(driver):
+    for index, item in enumerate(driver.execute_script(JS_LISTING)):
+        yield listing_record(index, item['name'], item['cells'])
+
+def scrape_listing(driver):
+
+    page = 0
     while True:
-        # Extract plumber
-        yield scrape_details(driver)
+        util.served(driver)
+        for row in util.read_page(driver, extract_listing, browser_listing):
+            row['_page'] = page
+            yield row
 
-        if not click_next_record(driver):
+        if not click_next_page(driver):
             break
+        page += 1
 
-    # Click to go back
-    elem = driver.find_element_by_name('newcriteria')
-    elem.click()
+def open_listing(driver, ct, row):
 
-def scrape_counties(driver):
+    # Search again and page forward to the row
+    new_criteria(driver)
+    search_county(driver, ct)
 
-    cts = county_options(driver)
+    for _ in range(row['_page']):
+        click_next_page(driver)
 
-    # Start from ...
-    # cts = cts[cts.index('48439'):]
+    elems = driver.find_elements_by_css_selector('span.item a')
+    click(driver, elems[row['_index']])
 
-    for ct in cts:
-        yield from scrape_county(driver, ct)
+def missing_runs(listing, store):
 
-def scrape_details(driver):
+    runs, last = [], None
+    for index, row in enumerate(listing):
+        if row in store: continue
+        if last is not None and last == index - 1:
+            runs[-1].append(row)
+        else:
+            runs.append([ row ])
+        last = index
 
-    data = dict()
+    return runs
 
-    html = driver.page_source
-    soup = BeautifulSoup(html, 'html.parser')
+def scrape_county(driver, ct, store):
 
-    elem = soup.find('input', attrs={'name': 'licNumber'})
-    data['License'] = elem['value']
+    print('Scraping county', ct)
+    if not search_county(driver, ct):
+        return
+
+    # Result pages are cheap, details are one page load each
+    listing = list(scrape_listing(driver))
+    runs = missing_runs(listing, store)
+    print(len(listing), 'listed,', sum(map(len, runs)), 'missing')
+
+    # Each run of consecutive missing rows is opened from the listing
+    # and walked with nextRow, known records are never loaded
+    for run in runs:
+        open_listing(driver, ct, run[0])
+        for i, row in enumerate(run):
+            if i and not click_next_record(driver):
+                break
+            yield scrape_details(driver)
+
+    new_criteria(driver)
+
+def county_jobs(driver, ranks):
+
+    # One job per (rank, county) not finished by an earlier run
+    cursor = util.read_json(CURSOR) or {}
+    jobs = queue.Queue()
+
+    for rank in ranks:
+        done = set(cursor.get(rank, []))
+        for ct in county_options(driver):
+            if ct in done: continue
+            jobs.put((rank, ct, 0))
+
+    return jobs, cursor
+
+def mark_done(cursor, rank, ct):
+    with LOCK:
+        cursor.setdefault(rank, []).append(ct)
+        util.replace_json(CURSOR, cursor)
+
+def scrape_jobs(drivers, jobs, store, cursor):
+
+    # Returns the counties given up on
+    failed = 0
+    while True:
+        try:
+            rank, ct, tries = jobs.get_nowait()
+        except queue.Empty:
+            return failed
+
+        # A failed county gets a fresh browser from the pool
+        try:
+            with drivers.driver(prepare_scrape) as driver:
+                select_by_name(driver, 'rankId', rank)
+                select_by_name(driver, 'pageSize', PAGE_SIZE)
+
+                for record in scrape_county(driver, ct, store):
+                    if record not in store:
+                        print('Scraped', record['License'])
+                        store.append(record)
+                    else:
+                        print('Already scraped', record['License'])
+
+        except Exception as e:
+            print('County', ct, 'rank', rank, 'failed:', e)
+            if tries < RETRIES:
+                jobs.put((rank, ct, tries + 1))
+            else:
+                failed += 1
+            continue
+
+        # The records have to be on disk before the county is
+        store.sync()
+        mark_done(cursor, rank, ct)
+
+def scrape_details(driver):
+    util.served(driver)
+    return util.read_page(driver, parse_details, browser_details)
+
+def details_record(license, values, tables):
+
+    data = dict()
+    data['License'] = license
 
-    elems = soup.find_all('td', attrs={'class': 'dataView'})
     keys = [ 'Name', 'Type', 'Status', 
             'Expiration', 'Certification of Insurance' ]
+    data.update(zip(keys, values))
 
-    for k, e in zip(keys, elems):
-        data[k] = e.get_text(strip=True)
-
-    elems = soup.select('span.item table')
     keys = [ 'Address', 'Phone' ]
-
-    for k, e in zip(keys, elems):
-        data[k] = e.get_text(', ', strip=True)
+    data.update(zip(keys, tables))
 
     return data
 
-def record_id(record):
-    keys = [ 'License', 'Name', 'Type' ]
-    return tuple( record[k] for k in keys )
+def parse_details(html):
 
-def format_record(record):
+    soup = util.soup(html)
+    elem = soup.find('input', attrs={'name': 'licNumber'})
 
-    data = OrderedDict.fromkeys(util.COLUMNS)
-    name = nameparser.HumanName(record['Name'])
+    elems = soup.find_all('td', attrs={'class': 'dataView'})
+    values = [ e.get_text(strip=True) for e in elems ]
 
-    keys = ['City', 'State', 'County', 'Zip Code']
-    addr = [ x.strip() for x in record['Address'].split(',') ]
+    elems = soup.select('span.item table')
+    tables = [ e.get_text(', ', strip=True) for e in elems ]
 
-    for k, value in zip(keys, addr):
-        data[k] = value
+    return details_record(elem['value'], values, tables)
 
-    data['First Name'] = name.first
-    data['Last Name'] = name.last
+def browser_details(driver):
+    data = driver.execute_script(JS_DETAILS)
+    return details_record(data['license'], data['values'], data['tables'])
 
-    data['License Number'] = record['License']
-    data['License Status'] = record['Status']
+def record_id(record):
+    keys = [ 'License', 'Name', 'Type' ]
+    return tuple( record[k] for k in keys )
 
-    data['Street Address 1'] = record.get('Address', '')
-    data['Phone'] = record.get('Phone', '')
+def export_table(records):
+    df = util.export_frame(records, FIELDS, name='Name')
 
-    data['Full Name'] = record['Name']
-    data['License Type'] = record['Type']
+    # County goes right after the shared columns, as it always has
+    df.insert(len(util.COLUMNS), 'County', None)
 
-    data['Expiration Date'] = record['Expiration']
-    data['Certification of Insurance'] = \
-            record['Certification of Insurance']
+    keys = ['City', 'State', 'County', 'Zip Code']
+    addr = df['Street Address 1'].str.split(',')
+    for i, k in enumerate(keys):
+        df[k] = addr.str[i].str.strip()
 
-    return data
+    return df
 
 def export_csv():
-    data = util.read_json('texas.json')
-    df = pd.DataFrame([ format_record(x) for x in data ])
+    df = export_table(util.load_records(STATE, FILENAME))
     df.to_csv('./texas.csv', index=None)
 
-def main():
-
-    driver = webdriver.Chrome()
+def main(workers=WORKERS, ranks=RANKS):
 
-    results = util.read_json(FILENAME)
-    scraped = set( record_id(x) for x in results )
+    store = util.RecordStore(STATE, record_id, FILENAME).open()
+    drivers = util.DriverPool(size=workers)
 
-    print('Preparing scrape')
-    prepare_scrape(driver)
-
-    # print('Select Journeyman')
-    # select_by_name(driver, 'rankId', '23')
+    try:
+        with drivers.driver(prepare_scrape) as driver:
+            jobs, cursor = county_jobs(driver, ranks)
+        print(jobs.qsize(), 'counties to scrape')
 
-    print('Select Master Plumber')
-    select_by_name(driver, 'rankId', '24')
+        # Every worker pulls from the same queue until it is empty
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [ pool.submit(scrape_jobs, drivers, jobs, store, cursor)
+                    for _ in range(workers) ]
+            failed = sum( fut.result() for fut in futures )
 
-    print('Select 10')
-    select_by_name(driver, 'pageSize', '10')
+        # A full pass starts the next run from scratch, the store
+        # still skips the details it already has
+        if not failed and os.path.exists(CURSOR):
+            os.remove(CURSOR)
 
-    for record in scrape_counties(driver):
-        if record_id(record) not in scraped:
-            print('Scraped', record['License'])
-            results.append(record)
-            util.write_json(FILENAME, results)
-        else:
-            print('Already scraped', record['License'])
+    finally:
+        drivers.close()
+        store.close()
 
 if __name__ == '__main__':
     main()
-
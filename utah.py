@@ -1,22 +1,30 @@
 #!/usr/bin/env python3
 
-import requests as rq
-import pandas as pd
 import re
 import util
-import sys
-import time
-import nameparser
+import functools
 
-from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from collections import OrderedDict
 
 URL = 'https://secure.utah.gov/llv/search/index.html'
+FILENAME = 'utah_ex.json'
+STATE = 'utah'
 KEYS = ('Name', 'City', 'Profession', 'License', 'Status')
+FIELDS = {
+    'File': 'href',
+    'City': 'City',
+    'License Number': 'License',
+    'License Status': 'Status',
+    'Full Name': 'Name',
+    'Profession': 'Profession',
+    'License Type': 'Type',
+    'Stree Address 1': 'Address',
+    'Obtained': 'Obtained',
+    'Issue Date': 'Issue',
+    'Expiration Date': 'Expiration' }
 
 def wait_for_elem(driver, by, query, timeout=20):
     # event = EC.visibility_of
@@ -54,10 +62,14 @@ def fetch_plumbers(driver, page):
 
     url = 'https://secure.utah.gov/llv/search/search.html?currentPage={}'
     url = url.format(page)
-    driver.get(url)
-    html = driver.page_source
+    navigate = functools.partial(driver.get, url)
+    html = util.snapshot(driver, url, navigate)
     return html
 
+def page_count(html):
+    pages = re.findall(r'currentPage=(\d+)', html)
+    return max([ 1 ] + [ int(x) for x in pages ])
+
 def parse_row(soup):
 
     data = dict.fromkeys(KEYS)
@@ -74,7 +86,7 @@ def parse_row(soup):
 
 def extract_plumbers(html):
     
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = util.soup(html)
     elem = soup.find('table', class_='resultsTable')
     rows = elem.tbody.find_all('tr', class_=re.compile(r'^bg_'))
     print('ROWS', len(rows))
@@ -82,41 +94,33 @@ def extract_plumbers(html):
     for tr in rows:
         yield parse_row(tr)
 
-def scrape_plumbers(driver, start=1):
-
-    for p in range(start, 352):
-        print('Fetching page', p)
-        html = fetch_plumbers(driver, p)
-        yield from extract_plumbers(html)
-        time.sleep(1)
+def scrape_shard(start, stop=None):
 
-def format_record(record):
+    # Result pages are plain URLs on the search session, so every
+    # shard jumps straight to its start
+    with util.driver_pool().driver(prepare_scrape) as driver:
+        page = start
+        while True:
+            print('Fetching page', page)
+            html = fetch_plumbers(driver, page)
+            yield from extract_plumbers(html)
 
-    data = OrderedDict.fromkeys(util.COLUMNS)
-    name = nameparser.HumanName(record['Name'])
+            page += 1
+            if page >= (stop or page_count(html) + 1): break
 
-    data['File'] = record['href']
-    data['Last Name'] = name.last
-    data['First Name'] = name.first
-    data['City'] = record['City']
-    data['License Number'] = record['License']
-    data['License Status'] = record['Status']
-    data['Full Name'] = record['Name']
+def scrape_plumbers(shards=util.BROWSERS):
 
-    data['Profession'] = record['Profession']
-    data['License Type'] = record['Type']
+    with util.driver_pool().driver(prepare_scrape) as driver:
+        count = page_count(fetch_plumbers(driver, 1))
+    print('Found', count, 'pages')
 
-    data['Stree Address 1'] = record['Address']
-    data['Obtained'] = record['Obtained']
+    yield from util.sharded(count, shards, scrape_shard)
 
-    data['Issue Date'] = record['Issue']
-    data['Expiration Date'] = record['Expiration']
-
-    return data
+def export_table(records):
+    return util.export_frame(records, FIELDS, name='Name')
 
 def export_csv():
-    data = util.read_json('utah_ex.json')
-    df = pd.DataFrame([ format_record(x) for x in data ])
+    df = export_table(util.load_records(STATE, FILENAME))
     df.to_csv('./utah.csv', index=None)
 
 def find_by_string(soup, string):
@@ -128,10 +132,10 @@ def scrape_details(record):
 
     url = record['href']
 
-    resp = rq.get(url)
+    resp = util.client().get(url)
     html = resp.text
 
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = util.soup(html)
 
     record['Address'] = find_by_string(soup, 'City, State, Zip, Country:')
     record['Profession'] = find_by_string(soup, 'Profession:')
@@ -150,29 +154,21 @@ def main():
     # driver = webdriver.Chrome()
     # prepare_scrape(driver)
 
-    filename = 'utah_ex.json'
 
     records = util.read_json('utah.json')
-    results = util.read_json(filename)
-    scraped = set( unique_record(x) for x in results )
+    store = util.RecordStore(STATE, unique_record, FILENAME).open()
 
     try:
-        for record in records:
-            if unique_record(record) in scraped:
-                print('Already scraped', record['License'])
-                continue
-
-            print('Scraping details', record['License'])
-            details = scrape_details(record)
-            results.append(details)
-            util.write_json(filename, results)
+        for details in util.fetch_details(records, scrape_details, store):
+            print('Scraped details', details['License'])
+            store.append(details)
 
     except Exception: 
         print('Some bullshit error...')
     except KeyboardInterrupt: 
         pass
     finally:
-        util.write_json(filename, results)
+        store.close()
 
 if __name__ == '__main__':
     main()
@@ -1,10 +1,133 @@
 #!/usr/bin/env python3
 
+import os
+import re
 import json
+import time
+import random
+import queue
+import atexit
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import functools
+import contextlib
+import datetime as dt
 import requests as rq
 import pandas as pd
+import nameparser
+
+from bs4 import BeautifulSoup
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.request import ACCEPT_ENCODING
 
 from selenium import webdriver
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import WebDriverException, TimeoutException
+
+# html.parser, lxml or html5lib, see bench.py
+PARSER = os.environ.get('PLUMBER_PARSER', 'html.parser')
+
+# on, off or replay (cache only, misses raise CacheMiss)
+CACHE = os.environ.get('PLUMBER_CACHE', 'on')
+CACHE_DIR = os.environ.get('PLUMBER_CACHE_DIR', 'cache')
+CACHE_BUDGET = int(os.environ.get('PLUMBER_CACHE_BUDGET', 2 * 2**30))
+
+# Seconds a cached response stays fresh, per portal host
+CACHE_TTL = 24 * 3600
+CACHE_TTLS = {
+    'dol.nebraska.gov': 7 * 24 * 3600,
+    'secure.utah.gov': 7 * 24 * 3600,
+    'search.msboc.us': 7 * 24 * 3600,
+}
+
+# PLUMBER_REFRESH=1 re-fetches details that are new, whose listing
+# row changed or whose license expires within REFRESH_DAYS
+REFRESH = os.environ.get('PLUMBER_REFRESH') == '1'
+REFRESH_DAYS = int(os.environ.get('PLUMBER_REFRESH_DAYS', 30))
+
+# Browsers per process, restarted after DRIVER_PAGES pages or once
+# they grow past DRIVER_MEMORY MB. PLUMBER_HEADLESS=0 to watch them
+BROWSERS = int(os.environ.get('PLUMBER_BROWSERS', 2))
+DRIVER_PAGES = int(os.environ.get('PLUMBER_DRIVER_PAGES', 500))
+DRIVER_MEMORY = int(os.environ.get('PLUMBER_DRIVER_MEMORY', 1024))
+HEADLESS = os.environ.get('PLUMBER_HEADLESS', '1') == '1'
+
+# Browsers only fetch documents and scripts, PLUMBER_BLOCK=0 to
+# load everything
+BLOCK = os.environ.get('PLUMBER_BLOCK', '1') == '1'
+BLOCKED_URLS = [
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg', '*.ico', '*.webp', '*.bmp',
+    '*.css', '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    '*google-analytics.com*', '*googletagmanager.com*', '*doubleclick.net*' ]
+
+# html parses the page source (and keeps snapshots for replay),
+# browser reads just the rows with a script in the page
+EXTRACT = os.environ.get('PLUMBER_EXTRACT', 'html')
+
+# Requests in flight per host start at RATE_START and grow while the
+# portal answers quickly, halving on 429/5xx, timeouts and empty pages
+RATE_START = 2
+RATE_MAX = int(os.environ.get('PLUMBER_RATE_MAX', 16))
+RETRIES = 5
+BACKOFF = 1
+BACKOFF_MAX = 60
+TIMEOUT = 30
+
+# Seconds between checks while waiting on the browser
+POLL = 0.05
+
+# Cheap page state: a hash of the text under a selector, null while
+# the document is still loading or the element is missing
+FINGERPRINT = '''
+if (document.readyState !== 'complete') return null;
+var elem = document.querySelector(arguments[0]);
+if (!elem) return null;
+var text = elem.innerText, hash = 0;
+for (var i = 0; i < text.length; i++)
+    hash = (hash * 31 + text.charCodeAt(i)) | 0;
+return text.length + ':' + hash;
+'''
+
+# Parsed names, kept out of CACHE_DIR so cache eviction can't drop it
+NAMES_FILE = os.environ.get('PLUMBER_NAMES', 'names.json')
+
+# One SQLite file holds every state's records, PLUMBER_DB to move it
+DATABASE = os.environ.get('PLUMBER_DB', 'plumbers.db')
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    state TEXT NOT NULL,
+    key TEXT NOT NULL,
+    license TEXT,
+    status TEXT,
+    expiration TEXT,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (state, key));
+CREATE INDEX IF NOT EXISTS records_license ON records (state, license);
+CREATE INDEX IF NOT EXISTS records_status ON records (state, status);
+CREATE INDEX IF NOT EXISTS records_expiration ON records (state, expiration);
+'''
+UPSERT = '''
+INSERT INTO records (state, key, license, status, expiration, data, updated)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (state, key) DO UPDATE SET
+    license = excluded.license, status = excluded.status,
+    expiration = excluded.expiration, data = excluded.data,
+    updated = excluded.updated
+'''
+
+# Record keys the indexed columns are read from, first one set wins
+LICENSE_KEYS = ( 'License', 'Number', 'PLNumber', 'Registration Number' )
+STATUS_KEYS = ( 'Status', 'License Status' )
+EXPIRATION_KEYS = ( 'Expiration', 'Expires', 'Expiration Date', 'ExpirationDate' )
+DATE_FORMATS = ( '%m/%d/%Y', '%Y-%m-%d', '%Y-%m-%dT%H:%M:%S' )
 
 COLUMNS = [
     'File',
@@ -23,6 +146,105 @@ COLUMNS = [
     'Company'
 ]
 
+def soup(html, parser=None):
+    return BeautifulSoup(html, parser or PARSER)
+
+# "LAST, FIRST M" and "FIRST M LAST" made of plain words split the same
+# way HumanName does, anything else goes through HumanName
+NAME_WORD = r"[^\W\d_](?:[^\W\d_'-]*|\.)"
+LAST_FIRST = re.compile(r'^({0}), ({0})(?: {0})?$'.format(NAME_WORD))
+FIRST_LAST = re.compile(r'^({0})(?: {0})? ({0})$'.format(NAME_WORD))
+
+_names = None
+_names_saved = 0
+
+@functools.lru_cache(maxsize=1)
+def name_words():
+    from nameparser.config import CONSTANTS, SetManager
+
+    # Every word HumanName treats specially (titles, suffixes,
+    # conjunctions, prefixes, bound first names, maiden markers ...)
+    words = set([ 'nee', 'née' ])
+    for group in vars(CONSTANTS).values():
+        if isinstance(group, SetManager):
+            words.update( x.lower() for x in group )
+    return words
+
+def fast_split(name):
+
+    words = name_words()
+    if any( x.lower().strip('.') in words for x in name.split() ):
+        return None
+
+    match = LAST_FIRST.match(name)
+    if match: return match.group(2), match.group(1)
+
+    match = FIRST_LAST.match(name)
+    if match: return match.group(1), match.group(2)
+
+def name_cache():
+    global _names, _names_saved
+    if _names is None:
+        data = read_json(NAMES_FILE) or {}
+        _names = { k: tuple(v) for k, v in data.items() }
+        _names_saved = len(_names)
+    return _names
+
+def save_names():
+    global _names_saved
+    names = name_cache()
+    if len(names) == _names_saved: return
+    os.makedirs(os.path.dirname(NAMES_FILE) or '.', exist_ok=True)
+    replace_json(NAMES_FILE, names)
+    _names_saved = len(names)
+
+@functools.lru_cache(maxsize=2**16)
+def split_name(raw):
+
+    # Returns (first, last)
+    key = ' '.join(raw.split())
+    fast = fast_split(key)
+    if fast is not None: return fast
+
+    names = name_cache()
+    if key not in names:
+        name = nameparser.HumanName(key)
+        names[key] = (name.first, name.last)
+
+    return names[key]
+
+def split_names(names):
+
+    # Each distinct name once, then mapped back as columns
+    parsed = { x: split_name(x) for x in names.dropna().unique() }
+    save_names()
+
+    first = { k: v[0] for k, v in parsed.items() }
+    last = { k: v[1] for k, v in parsed.items() }
+
+    return names.map(first), names.map(last)
+
+def expiry_status(dates, fmt):
+    exp = pd.to_datetime(dates, format=fmt, errors='coerce')
+    status = exp.lt(pd.Timestamp.now()).map({ True: 'Expired', False: 'Active' })
+    return status.where(exp.notna())
+
+def export_frame(records, fields, name=None):
+
+    # fields maps output column -> raw record key. Output is COLUMNS
+    # followed by the state specific columns in fields order.
+    raw = pd.DataFrame.from_records(records)
+    columns = COLUMNS + [ k for k in fields if k not in COLUMNS ]
+    out = pd.DataFrame(index=raw.index, columns=columns)
+
+    if name in raw:
+        out['First Name'], out['Last Name'] = split_names(raw[name])
+
+    for col, src in fields.items():
+        if src in raw: out[col] = raw[src]
+
+    return out
+
 def read_json(filename):
     try:
         data = []
@@ -35,9 +257,1145 @@ def write_json(filename, data):
     with open(filename, 'w', encoding='utf8') as fp:
         json.dump(data, fp, indent=2)
 
+def read_jsonl(filename):
+    try:
+        with open(filename, 'r', encoding='utf8') as fp:
+            for line in fp:
+                try:
+                    yield json.loads(line)
+                # Torn last line from a crash
+                except ValueError: pass
+    except FileNotFoundError: pass
+
+def replace_json(filename, data):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w', encoding='utf8') as fp:
+        json.dump(data, fp, indent=2)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, filename)
+
+def legacy_records(filename):
+
+    # A state's old JSON checkpoint: the compacted <name>.json and the
+    # <name>.jsonl log an interrupted run left behind
+    yield from read_json(filename)
+    yield from read_jsonl(os.path.splitext(filename)[0] + '.jsonl')
+
+class RecordStore:
+
+    # Every state's records in one SQLite table keyed on (state, key):
+    # the record as JSON next to indexed license, status and expiration
+    # columns. Appends are buffered and upserted a batch per
+    # transaction. WAL lets other processes read while one writes and
+    # the busy timeout queues their writers, threads share the
+    # connection under a lock. legacy is the state's old JSON
+    # checkpoint, imported the first time the state is opened
+
+    def __init__(self, state, key=None, legacy=None, filename=DATABASE, batch=500):
+        self.state = state
+        self.key = key
+        self.legacy = legacy
+        self.filename = filename
+        self.batch = batch
+        self.pending = dict()
+        self.db = None
+        self.lock = threading.RLock()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, record):
+        return self.seen(self.key(record))
+
+    def __len__(self):
+        self.sync()
+        with self.lock:
+            sql = 'SELECT COUNT(*) FROM records WHERE state = ?'
+            return self.db.execute(sql, (self.state,)).fetchone()[0]
+
+    def connect(self):
+        db = sqlite3.connect(self.filename, timeout=60,
+                isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def open(self):
+        self.db = self.connect()
+        self.db.executescript(SCHEMA)
+
+        if self.legacy and self.key and self.empty():
+            for chunk in chunked(legacy_records(self.legacy), self.batch):
+                self.extend(chunk)
+
+        return self
+
+    def empty(self):
+        sql = 'SELECT 1 FROM records WHERE state = ? LIMIT 1'
+        with self.lock:
+            return self.db.execute(sql, (self.state,)).fetchone() is None
+
+    def encode(self, key):
+        return json.dumps(key)
+
+    def row(self, record):
+        exp = expiration(record)
+        return (self.state, self.encode(self.key(record)),
+                first_value(record, LICENSE_KEYS),
+                first_value(record, STATUS_KEYS),
+                exp.date().isoformat() if exp else None,
+                json.dumps(record), time.time())
+
+    def seen(self, key):
+        key = self.encode(key)
+        sql = 'SELECT 1 FROM records WHERE state = ? AND key = ?'
+        with self.lock:
+            if key in self.pending: return True
+            return self.db.execute(sql, (self.state, key)).fetchone() is not None
+
+    def get(self, key):
+        key = self.encode(key)
+        sql = 'SELECT data FROM records WHERE state = ? AND key = ?'
+        with self.lock:
+            if key in self.pending: return self.pending[key]
+            row = self.db.execute(sql, (self.state, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def records(self, license=None, status=None, expires_after=None, expires_before=None):
+
+        # Streams off its own connection, so the read sees one snapshot
+        # and doesn't hold the writer's lock. Dates are ISO strings
+        self.sync()
+        sql = 'SELECT data FROM records WHERE state = ?'
+        args = [ self.state ]
+
+        for clause, value in (('license = ?', license), ('status = ?', status),
+                ('expiration >= ?', expires_after), ('expiration < ?', expires_before)):
+            if value is None: continue
+            sql += ' AND ' + clause
+            args.append(value)
+
+        db = self.connect()
+        try:
+            for (data,) in db.execute(sql + ' ORDER BY rowid', args):
+                yield json.loads(data)
+        finally:
+            db.close()
+
+    def append(self, record):
+        with self.lock:
+            self.pending[self.encode(self.key(record))] = record
+            if len(self.pending) >= self.batch:
+                self.sync()
+
+    def extend(self, records):
+
+        # One transaction for the whole batch
+        with self.lock:
+            for record in records:
+                self.pending[self.encode(self.key(record))] = record
+            self.sync()
+
+    def sync(self):
+        with self.lock:
+            if not self.pending or self.db is None: return
+            rows = [ self.row(x) for x in self.pending.values() ]
+
+            # IMMEDIATE takes the write lock up front, a deferred
+            # transaction could deadlock upgrading from a read
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.executemany(UPSERT, rows)
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.pending.clear()
+
+    def close(self):
+        if self.db is None: return
+        self.sync()
+        self.db.close()
+        self.db = None
+
+def state_records(state, legacy=None):
+
+    # Everything scraped for state, streamed. The old JSON checkpoint
+    # stands in until the state has been scraped into the store
+    with RecordStore(state) as store:
+        empty = store.empty()
+        if not empty:
+            yield from store.records()
+
+    if empty and legacy:
+        yield from legacy_records(legacy)
+
+def load_records(state, legacy=None):
+    return list(state_records(state, legacy))
+
+def first_value(record, keys):
+    for k in keys:
+        if record.get(k): return record[k]
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
+
+def parse_date(value):
+    for fmt in DATE_FORMATS:
+        try:
+            return dt.datetime.strptime(value, fmt)
+        except (TypeError, ValueError): pass
+
+def expiration(record):
+    for k in EXPIRATION_KEYS:
+        date = parse_date(record.get(k))
+        if date is not None: return date
+
+def row_hash(record, fields=None):
+    fields = sorted( k for k in (fields or record) if not k.startswith('_') )
+    data = json.dumps([ (k, record.get(k)) for k in fields ])
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+def needs_refresh(record, prev, days=REFRESH_DAYS):
+
+    if prev is None: return True
+
+    # Listing row changed (compared on the listing's own fields)
+    if row_hash(record) != row_hash(prev, record):
+        return True
+
+    # Expiring soon or just expired, it may have been renewed
+    exp = expiration(prev)
+    if exp is not None and abs((exp - dt.datetime.now()).days) <= days:
+        return True
+
+    status = prev.get('Status') or ''
+    return 'pending' in status.lower()
+
+def not_modified(prev):
+
+    # Conditional GET with the validators saved on the last scrape
+    headers = dict()
+    if prev.get('_etag'): headers['If-None-Match'] = prev['_etag']
+    if prev.get('_modified'): headers['If-Modified-Since'] = prev['_modified']
+    if not headers or not prev.get('href'): return False
+
+    resp = client().get(prev['href'], headers=headers)
+    return resp.status_code == 304
+
+def save_validators(record):
+    seen = client().validators.get(record.get('href'), {})
+    if seen.get('ETag'): record['_etag'] = seen['ETag']
+    if seen.get('Last-Modified'): record['_modified'] = seen['Last-Modified']
+    return record
+
+def record_host(record):
+    return urlparse(record.get('href', '')).netloc
+
+def ordered_map(fn, items, workers=8, executor=ThreadPoolExecutor):
+
+    # pool.map that stays lazy: at most workers * 2 calls in flight,
+    # results in input order. executor makes the pool, threads by default
+    window = deque()
+    with executor(max_workers=workers) as pool:
+        for item in items:
+            window.append(pool.submit(fn, item))
+            if len(window) >= workers * 2:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+def fetch_details(records, scrape, store=None, workers=16, per_host=RATE_MAX,
+        ordered=True, host=record_host, refresh=None):
+
+    # Runs scrape(record) on a thread pool with at most per_host
+    # records in flight per host, the rate limiter below decides how
+    # many of their requests actually run at once. Records already in the store (or
+    # already queued) are skipped, unless refreshing, in which case
+    # needs_refresh decides. Yields results in listing order when
+    # ordered, otherwise as they complete.
+
+    lock = threading.Lock()
+    limits = dict()
+    queued = set()
+
+    if refresh is None: refresh = REFRESH
+    refresh = refresh and store is not None
+
+    def limit(name):
+        with lock:
+            if name not in limits:
+                limits[name] = threading.BoundedSemaphore(per_host)
+            return limits[name]
+
+    def task(record):
+        with limit(host(record)):
+            if not refresh:
+                return save_validators(scrape(record))
+
+            # Refreshes go past the cache, a cached page is what's
+            # being checked. On 304 the new listing fields still win
+            prev = store.get(store.key(record))
+            with bypass_cache():
+                if prev is not None and not_modified(prev):
+                    return dict(prev, **record)
+                return save_validators(scrape(record))
+
+    def fresh(record):
+        if store is None: return True
+        key = store.key(record)
+        if key in queued: return False
+        if refresh:
+            if not needs_refresh(record, store.get(key)):
+                return False
+        elif store.seen(key):
+            return False
+        queued.add(key)
+        return True
+
+    window = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+
+        for record in records:
+            if not fresh(record): continue
+            window.append(pool.submit(task, record))
+
+            # Keep the window small so the listing stays lazy
+            while len(window) >= workers * 2:
+                if ordered:
+                    yield window.popleft().result()
+                    continue
+                done, _ = wait(window, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    window.remove(fut)
+                    yield fut.result()
+
+        if not ordered:
+            window = as_completed(window)
+        for fut in window:
+            yield fut.result()
+
+class Throttled(Exception):
+
+    # Response the portal should not have sent if it were healthy
+
+    def __init__(self, response):
+        super().__init__('{} {}'.format(response.status_code, response.url))
+        self.response = response
+        self.retry_after = None
+        value = response.headers.get('Retry-After', '')
+        if value.isdigit():
+            self.retry_after = int(value)
+
+RETRYABLE = ( Throttled, rq.Timeout, rq.ConnectionError, TimeoutException )
+
+def backoff(failures):
+    # Full jitter, so the threads of a host don't retry in step
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF * 2**failures))
+
+class HostLimit:
+
+    # Additive increase, multiplicative decrease on the number of
+    # requests in flight. A failure also holds every request to the
+    # host back for a jittered, exponentially growing pause.
+
+    def __init__(self, start=RATE_START, maximum=RATE_MAX):
+        self.limit = float(start)
+        self.maximum = maximum
+        self.active = 0
+        self.resume = 0
+        self.failures = 0
+        self.latency = None
+        self.floor = None
+        self.requests = 0
+        self.errors = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                wait = self.resume - time.time()
+                if wait <= 0 and self.active < int(self.limit): break
+                self.cond.wait(wait if wait > 0 else None)
+            self.active += 1
+
+    def release(self, ok, latency=0, delay=None):
+        with self.cond:
+            self.active -= 1
+            self.requests += 1
+
+            if ok:
+                self.failures = 0
+                self.latency = latency if self.latency is None \
+                        else 0.8 * self.latency + 0.2 * latency
+                # The baseline drifts up so a slower portal finds its own
+                self.floor = self.latency if self.floor is None \
+                        else min(self.floor * 1.01, self.latency)
+
+                # Slower than usual means the portal is queueing us
+                if self.latency > 2 * self.floor:
+                    self.limit = max(1, self.limit * 0.9)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            else:
+                self.errors += 1
+                self.failures += 1
+                self.limit = max(1, self.limit / 2)
+                pause = delay if delay is not None else backoff(self.failures)
+                self.resume = max(self.resume, time.time() + pause)
+
+            self.cond.notify_all()
+
+    def stats(self):
+        return {
+            'limit': int(self.limit), 'requests': self.requests,
+            'errors': self.errors, 'latency': self.latency }
+
+class RateLimiter:
+
+    def __init__(self):
+        self.hosts = dict()
+        self.lock = threading.Lock()
+
+    def host(self, name):
+        with self.lock:
+            if name not in self.hosts:
+                self.hosts[name] = HostLimit()
+            return self.hosts[name]
+
+    def call(self, name, fn, retries=RETRIES):
+
+        limit = self.host(name)
+        for attempt in range(retries + 1):
+            limit.acquire()
+            start = time.time()
+            try:
+                result = fn()
+            except RETRYABLE as e:
+                limit.release(False, delay=getattr(e, 'retry_after', None))
+                if attempt == retries: raise
+                print('Retrying', name, 'after', e)
+                continue
+            except BaseException:
+                limit.release(True, time.time() - start)
+                raise
+
+            limit.release(True, time.time() - start)
+            return result
+
+    def stats(self):
+        with self.lock:
+            return { k: v.stats() for k, v in self.hosts.items() }
+
+_limiter = RateLimiter()
+
+def limiter():
+    return _limiter
+
+def throttled(resp, stream=False):
+    if resp.status_code == 429 or resp.status_code >= 500:
+        return True
+    return not stream and resp.status_code == 200 and not resp.content
+
+def browse(driver, action, host=None):
+
+    # Browser navigation through the same per-host limiter
+    host = host or urlparse(driver.current_url).netloc
+    return limiter().call(host, action)
+
+def fingerprint(driver, selector):
+    return driver.execute_script(FINGERPRINT, selector)
+
+def wait_for_change(driver, action, selector, timeout=TIMEOUT, poll=POLL):
+
+    # Runs action (a click or select that posts back) and waits for
+    # the text under selector to change. False when the page reloaded
+    # unchanged or nothing happened within timeout
+    olds = driver.find_elements_by_css_selector(selector)
+    before = fingerprint(driver, selector)
+    action()
+
+    def settled(driver):
+        now = fingerprint(driver, selector)
+        if now is None: return None
+        if now != before: return 'changed'
+        if olds and EC.staleness_of(olds[0])(driver): return 'same'
+        return None
+
+    wait = WebDriverWait(driver, timeout, poll_frequency=poll,
+            ignored_exceptions=(WebDriverException,))
+    try:
+        return wait.until(settled) == 'changed'
+    except TimeoutException:
+        return False
+
+def shard_bounds(pages, shards):
+
+    # Contiguous [start, stop) page ranges, the last one open ended so
+    # pages added since the count are still read
+    shards = max(1, min(shards, pages))
+    size = -(-pages // shards)
+    starts = list(range(1, pages + 1, size))
+    return [ (a, b) for a, b in zip(starts, starts[1:] + [None]) ]
+
+def sharded(pages, shards, fetch_shard):
+
+    # Runs fetch_shard(start, stop) for every shard on its own thread
+    # and yields their items in page order. Later shards keep fetching
+    # into their queue while the earlier ones are drained
+    bounds = shard_bounds(pages, shards)
+    queues = [ queue.Queue() for _ in bounds ]
+    cancel = threading.Event()
+    done = object()
+
+    def run(q, start, stop):
+        try:
+            for item in fetch_shard(start, stop):
+                if cancel.is_set(): break
+                q.put(item)
+        except BaseException as e:
+            q.put(e)
+        q.put(done)
+
+    with ThreadPoolExecutor(max_workers=len(bounds)) as pool:
+        for q, (start, stop) in zip(queues, bounds):
+            pool.submit(run, q, start, stop)
+
+        try:
+            for q in queues:
+                while True:
+                    item = q.get()
+                    if item is done: break
+                    if isinstance(item, BaseException): raise item
+                    yield item
+        finally:
+            cancel.set()
+
+class CacheMiss(Exception):
+    pass
+
+class Cache:
+
+    # Content addressed store: <dir>/<xx>/<sha256> holds the body and
+    # <sha256>.json the metadata. Hits refresh the mtime so eviction
+    # drops the least recently used entries first.
+
+    def __init__(self, path=CACHE_DIR, budget=CACHE_BUDGET, replay=False):
+        self.path = path
+        self.budget = budget
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.size = sum( os.path.getsize(x) for x, _ in self.entries() )
+
+    def entries(self):
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    yield path, os.stat(path).st_mtime
+                except FileNotFoundError: pass
+
+    def location(self, key):
+        digest = hashlib.sha256(key).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def get(self, key, ttl=CACHE_TTL):
+
+        path = self.location(key)
+        try:
+            with open(path + '.json', 'r', encoding='utf8') as fp:
+                meta = json.load(fp)
+            with open(path, 'rb') as fp:
+                body = fp.read()
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+
+        # Entries from before digests were kept are taken as they are
+        if 'digest' in meta and meta['digest'] != body_digest(body):
+            self.misses += 1
+            return None
+
+        # Replays never expire
+        if not self.replay and time.time() - meta['time'] > ttl:
+            self.misses += 1
+            return None
+
+        now = time.time()
+        for x in (path, path + '.json'):
+            try:
+                os.utime(x, (now, now))
+            except FileNotFoundError: pass
+
+        self.hits += 1
+        return meta, body
+
+    def put(self, key, meta, body):
+
+        path = self.location(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # The metadata goes last and names the body it belongs to, so
+        # a crash or a concurrent put of the same key can leave a pair
+        # that doesn't match, which reads as a miss, never a torn hit
+        meta = dict(meta, time=time.time(), digest=body_digest(body))
+        data = json.dumps(meta).encode('utf8')
+
+        for name, content in ((path, body), (path + '.json', data)):
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    fp.write(content)
+                os.replace(tmp, name)
+            except BaseException:
+                os.remove(tmp)
+                raise
+
+        with self.lock:
+            self.size += len(body) + len(data)
+            if self.size > self.budget:
+                self.evict()
+
+    def evict(self):
+
+        # Down to 90% so we don't evict on every put
+        target = self.budget * 0.9
+        entries = sorted(self.entries(), key=lambda x: x[1])
+        self.size = sum( os.path.getsize(x) for x, _ in entries )
+
+        for path, _ in entries:
+            if self.size <= target: break
+            try:
+                self.size -= os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError: pass
+
+    def stats(self):
+        return { 'hits': self.hits, 'misses': self.misses, 'bytes': self.size }
+
+def body_digest(body):
+    return hashlib.sha1(body).hexdigest()
+
+def default_cache():
+    if CACHE == 'off': return None
+    return Cache(replay=(CACHE == 'replay'))
+
+def request_key(request):
+    body = request.body or b''
+    if isinstance(body, str):
+        body = body.encode('utf8')
+    head = '{} {}\n'.format(request.method, request.url)
+    return head.encode('utf8') + body
+
+def restore_cookies(jar, meta):
+
+    # Entries from before cookies kept their scope were plain dicts,
+    # those are scoped to the host that set them
+    cookies = meta['cookies']
+    if isinstance(cookies, dict):
+        host = urlparse(meta['url']).hostname or ''
+        cookies = [ { 'name': k, 'value': v, 'domain': host, 'path': '/' }
+                for k, v in cookies.items() ]
+
+    for ck in cookies:
+        jar.set(ck['name'], ck['value'], domain=ck['domain'], path=ck['path'])
+
+_bypass = threading.local()
+
+def bypassing():
+    return getattr(_bypass, 'on', False)
+
+@contextlib.contextmanager
+def bypass_cache():
+
+    # Requests made on this thread skip cache lookups
+    previous = bypassing()
+    _bypass.on = True
+    try:
+        yield
+    finally:
+        _bypass.on = previous
+
+def conditional(request):
+    return 'If-None-Match' in request.headers \
+            or 'If-Modified-Since' in request.headers
+
+def cached_response(request, meta, body):
+    resp = rq.Response()
+    resp.status_code = meta['status']
+    resp.reason = 'OK'
+    resp.url = meta['url']
+    resp.headers = CaseInsensitiveDict(meta['headers'])
+    resp.encoding = meta['encoding']
+    resp.request = request
+    resp._content = body
+    return resp
+
+def snapshot(driver, key, navigate=None):
+
+    # Browser pages: always navigate live (the browser state has to
+    # advance), keep the page source, and serve it back in replay
+    cache = client().cache
+    if cache is None:
+        if navigate: browse(driver, navigate)
+        served(driver)
+        return driver.page_source
+
+    key = 'SNAPSHOT {}'.format(key).encode('utf8')
+    if cache.replay:
+        hit = cache.get(key)
+        if hit is None: raise CacheMiss(key)
+        return hit[1].decode('utf8')
+
+    if navigate: browse(driver, navigate)
+    served(driver)
+    html = driver.page_source
+    meta = { 'url': driver.current_url }
+    cache.put(key, meta, html.encode('utf8'))
+    return html
+
+# Prefix for in-page scripts: text() joins the stripped text nodes
+# like get_text(sep, strip=True), row() reads cells and anchors
+JS_TEXT = '''
+function text(node, sep) {
+    var walker = document.createTreeWalker(node, NodeFilter.SHOW_TEXT);
+    var parts = [], n, t;
+    while ((n = walker.nextNode()))
+        if ((t = n.data.trim())) parts.push(t);
+    return parts.join(sep || '');
+}
+function row(tr, cells) {
+    var map = Array.prototype.map;
+    return {
+        cells: map.call(tr.querySelectorAll(cells), function (td) {
+            return text(td);
+        }),
+        anchors: map.call(tr.querySelectorAll('a'), function (a) {
+            return { href: a.getAttribute('href'),
+                onclick: a.getAttribute('onclick'), text: text(a) };
+        })
+    };
+}
+'''
+
+JS_ROWS = JS_TEXT + '''
+var table = document.querySelector(arguments[0]), cells = arguments[2];
+if (!table) return null;
+return Array.prototype.map.call(table.querySelectorAll(arguments[1]),
+    function (tr) { return row(tr, cells); });
+'''
+
+def table_rows(driver, table, rows=':scope > tbody > tr', cells=':scope > td'):
+
+    # Cell texts and anchor attributes of each row, None without the
+    # table. Only these cross the WebDriver wire, not the page source
+    return driver.execute_script(JS_ROWS, table, rows, cells)
+
+def read_page(driver, from_html, from_browser):
+    if EXTRACT == 'browser':
+        return from_browser(driver)
+    return from_html(driver.page_source)
+
+def page_rows(driver, key, navigate, from_html, from_browser):
+
+    # Replays can only come from snapshots
+    cache = client().cache
+    if EXTRACT != 'browser' or (cache is not None and cache.replay):
+        return from_html(snapshot(driver, key, navigate))
+
+    if navigate: browse(driver, navigate)
+    served(driver)
+    return from_browser(driver)
+
+class LimitedAdapter(HTTPAdapter):
+
+    # Every hop on the wire goes through the host's limiter, with
+    # retries. Once retries run out the last response is returned
+
+    def send(self, request, **kwargs):
+
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = TIMEOUT
+        stream = kwargs.get('stream', False)
+
+        def fetch():
+            resp = super(LimitedAdapter, self).send(request, **kwargs)
+            if throttled(resp, stream):
+                raise Throttled(resp)
+            return resp
+
+        try:
+            return limiter().call(urlparse(request.url).netloc, fetch)
+        except Throttled as e:
+            return e.response
+
+class Client(rq.Session):
+
+    # Keep-alive pool shared by every scraper in the process.
+    # ACCEPT_ENCODING includes br when brotli is installed.
+
+    def __init__(self, pool=16, cache=None):
+        super().__init__()
+        adapter = LimitedAdapter(pool_connections=pool, pool_maxsize=pool)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        self.snapshot = None
+        self.cache = cache
+        self.validators = dict()
+
+    def remember(self, resp):
+        headers = { k: resp.headers[k] for k in ('ETag', 'Last-Modified')
+                if k in resp.headers }
+        if headers and resp.request.method == 'GET':
+            self.validators[resp.request.url] = headers
+
+    def send(self, request, **kwargs):
+
+        # Only cache whole exchanges, not the hops of a redirect
+        cache = self.cache
+        if cache is None or kwargs.get('stream') \
+                or not kwargs.get('allow_redirects', True):
+            resp = super().send(request, **kwargs)
+            self.remember(resp)
+            return resp
+
+        # Conditional and refresh requests have to reach the portal,
+        # the response is still stored for later runs
+        key = request_key(request)
+        host = urlparse(request.url).netloc
+        hit = None
+        if cache.replay or not (bypassing() or conditional(request)):
+            hit = cache.get(key, CACHE_TTLS.get(host, CACHE_TTL))
+
+        if hit is not None:
+            meta, body = hit
+            restore_cookies(self.cookies, meta)
+            resp = cached_response(request, meta, body)
+            self.remember(resp)
+            return resp
+
+        if cache.replay:
+            raise CacheMiss(request.url)
+
+        resp = super().send(request, **kwargs)
+        self.remember(resp)
+        if resp.status_code != 200:
+            return resp
+
+        cookies = [ { 'name': c.name, 'value': c.value,
+                'domain': c.domain, 'path': c.path }
+                for r in resp.history + [resp] for c in r.cookies ]
+
+        # Body is stored decoded
+        headers = { k: v for k, v in resp.headers.items()
+                if k.lower() not in ('content-encoding', 'content-length') }
+
+        meta = {
+            'url': resp.url, 'status': resp.status_code,
+            'encoding': resp.encoding, 'headers': headers,
+            'cookies': cookies }
+        cache.put(key, meta, resp.content)
+
+        return resp
+
+    def sync(self, driver):
+
+        cookies = driver.get_cookies()
+        snapshot = frozenset( (x['name'], x['value']) for x in cookies )
+        if snapshot == self.snapshot:
+            return self
+
+        # Scoped like the browser had them, so one portal's session
+        # isn't sent to every other host
+        for ck in cookies:
+            self.cookies.set(ck['name'], ck['value'],
+                    domain=ck.get('domain', ''), path=ck.get('path', '/'))
+        self.snapshot = snapshot
+
+        return self
+
+    def stats(self):
+
+        data = dict()
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                data[pool.host] = {
+                    'requests': pool.num_requests,
+                    'connections': pool.num_connections }
+
+        return data
+
+def chrome_options():
+    options = webdriver.ChromeOptions()
+    if HEADLESS:
+        options.add_argument('--headless')
+    options.add_argument('--disable-gpu')
+    options.add_argument('--disable-dev-shm-usage')
+    options.add_argument('--disable-extensions')
+
+    if BLOCK:
+        options.add_argument('--blink-settings=imagesEnabled=false')
+        options.add_experimental_option('prefs', {
+            'profile.managed_default_content_settings.images': 2 })
+        options.set_capability('goog:loggingPrefs', { 'performance': 'ALL' })
+
+    return options
+
+def start_chrome():
+
+    driver = webdriver.Chrome(options=chrome_options())
+    if BLOCK:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', { 'urls': BLOCKED_URLS })
+
+    return driver
+
+_asset_sizes = dict()
+
+def asset_size(url):
+
+    # What a blocked asset would have cost, asked once per url and
+    # outside the limiter. Only DriverPool.stats asks, never a scraper
+    if url not in _asset_sizes:
+        try:
+            resp = rq.head(url, allow_redirects=True, timeout=5)
+            size = int(resp.headers.get('Content-Length', 0))
+        except (rq.RequestException, ValueError):
+            size = 0
+        _asset_sizes[url] = size
+
+    return _asset_sizes[url]
+
+def page_weight(driver):
+
+    # Bytes received and urls blocked since the last call, read off
+    # the performance log. None when the log isn't enabled
+    try:
+        entries = driver.get_log('performance')
+    except (AttributeError, WebDriverException):
+        return None
+
+    urls, blocked = dict(), []
+    received = 0
+
+    for entry in entries:
+        message = json.loads(entry['message'])['message']
+        method, params = message.get('method'), message.get('params', {})
+
+        if method == 'Network.requestWillBeSent':
+            urls[params['requestId']] = params['request']['url']
+        elif method == 'Network.loadingFinished':
+            received += params.get('encodedDataLength', 0)
+        elif method == 'Network.loadingFailed' and params.get('blockedReason'):
+            blocked.append(urls.get(params['requestId']))
+
+    return { 'received': int(received), 'blocked': [ x for x in blocked if x ] }
+
+def served(driver, pages=1):
+
+    driver.pages_served = getattr(driver, 'pages_served', 0) + pages
+    if not BLOCK: return
+
+    weight = page_weight(driver)
+    if weight is None: return
+
+    # Blocked urls are only counted here, what they would have cost
+    # is estimated from the pool's stats
+    if not hasattr(driver, 'blocked_urls'):
+        driver.blocked_urls = Counter()
+    driver.blocked_urls.update(weight['blocked'])
+    driver.bytes_received = getattr(driver, 'bytes_received', 0) + weight['received']
+    print('Page {:.0f} KB, {} blocked requests'.format(
+        weight['received'] / 1024, len(weight['blocked'])))
+
+def process_memory(pid):
+
+    # Resident bytes of pid and everything it started, 0 without /proc
+    children = dict()
+    try:
+        names = [ x for x in os.listdir('/proc') if x.isdigit() ]
+    except OSError:
+        return 0
+
+    for name in names:
+        try:
+            with open('/proc/{}/stat'.format(name)) as fp:
+                ppid = int(fp.read().rsplit(')', 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(name))
+        except (OSError, ValueError, IndexError): pass
+
+    total, stack = 0, [pid]
+    page = os.sysconf('SC_PAGE_SIZE')
+    while stack:
+        pid = stack.pop()
+        try:
+            with open('/proc/{}/statm'.format(pid)) as fp:
+                total += int(fp.read().split()[1]) * page
+        except (OSError, ValueError, IndexError): pass
+        stack.extend(children.get(pid, []))
+
+    return total
+
+def driver_memory(driver):
+    process = getattr(getattr(driver, 'service', None), 'process', None)
+    return process_memory(process.pid) if process else 0
+
+class DriverPool:
+
+    # Warm browsers handed out to scraper jobs. A browser goes back
+    # to the pool after each job, keeping its prepared search, and is
+    # restarted when it died, failed a job, served max_pages pages
+    # or grew past max_memory MB
+
+    def __init__(self, size=BROWSERS, max_pages=DRIVER_PAGES,
+            max_memory=DRIVER_MEMORY, start=start_chrome):
+        self.size = size
+        self.max_pages = max_pages
+        self.max_memory = max_memory * 2**20
+        self.start = start
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.prepared = dict()
+        self.started = 0
+        self.restarted = 0
+        self.received = 0
+        self.blocked = Counter()
+
+    def alive(self, driver):
+        try:
+            driver.current_url
+            return True
+        except WebDriverException:
+            return False
+
+    def worn(self, driver):
+        if getattr(driver, 'pages_served', 0) >= self.max_pages:
+            return True
+        return driver_memory(driver) > self.max_memory
+
+    def quit(self, driver):
+        self.prepared.pop(driver, None)
+        self.received += getattr(driver, 'bytes_received', 0)
+        self.blocked.update(getattr(driver, 'blocked_urls', {}))
+        try:
+            driver.quit()
+        except WebDriverException: pass
+
+    def acquire(self, prepare=None):
+
+        self.slots.acquire()
+        try:
+            with self.lock:
+                driver = self.idle.pop() if self.idle else None
+
+            if driver is not None and not self.alive(driver):
+                print('Restarting crashed browser')
+                self.quit(driver)
+                self.restarted += 1
+                driver = None
+
+            if driver is None:
+                driver = self.start()
+                self.started += 1
+
+            # Reused browsers are still on the prepared search
+            if prepare is not None and self.prepared.get(driver) != prepare:
+                try:
+                    prepare(driver)
+                except BaseException:
+                    self.quit(driver)
+                    raise
+                self.prepared[driver] = prepare
+
+            return driver
+
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, driver, broken=False):
+
+        try:
+            if broken or self.worn(driver):
+                self.quit(driver)
+                self.restarted += 1
+            else:
+                with self.lock:
+                    self.idle.append(driver)
+        finally:
+            self.slots.release()
+
+    @contextlib.contextmanager
+    def driver(self, prepare=None):
+
+        # A job that raised leaves the page in an unknown state
+        driver = self.acquire(prepare)
+        try:
+            yield driver
+        except BaseException:
+            self.release(driver, broken=True)
+            raise
+        self.release(driver)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for driver in idle:
+            self.quit(driver)
+
+    def stats(self):
+
+        # Browsers still idle haven't handed in their counts yet. The
+        # savings estimate HEADs each distinct blocked url once
+        with self.lock:
+            drivers = list(self.idle)
+        received = self.received + sum( getattr(x, 'bytes_received', 0) for x in drivers )
+        blocked = Counter(self.blocked)
+        for driver in drivers:
+            blocked.update(getattr(driver, 'blocked_urls', {}))
+
+        return {
+            'started': self.started, 'restarted': self.restarted,
+            'received': received, 'blocked': sum(blocked.values()),
+            'saved': sum( asset_size(x) * n for x, n in blocked.items() ) }
+
+_drivers = None
+_drivers_lock = threading.Lock()
+
+def driver_pool():
+    global _drivers
+    with _drivers_lock:
+        if _drivers is None:
+            _drivers = DriverPool()
+            atexit.register(_drivers.close)
+        return _drivers
+
+_client = None
+_client_lock = threading.Lock()
+
+def client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = Client(cache=default_cache())
+        return _client
+
 def session_from_driver(driver):
-    s = rq.Session()
-    for ck in driver.get_cookies():
-        s.cookies.set(ck['name'], ck['value'])
-    return s
+    return client().sync(driver)
 
@@ -7,18 +7,33 @@
 # Classification
 # Expires
 
-import pandas as pd
-import requests as rq
-import json
+import os
+import re
+import itertools
+import functools
+import multiprocessing as mp
 import util
-import nameparser
-import datetime as dt
 
-from bs4 import BeautifulSoup
-from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 URL  = 'http://www.wvlabor.com/new_searches/plumber_RESULTS.cfm'
+FILENAME = 'westvirginia.json'
+STATE = 'westvirginia'
 KEYS = ('PLNumber', 'Name', 'City', 'County', 'Classification', 'Expires')
+FIELDS = {
+    'City': 'City',
+    'License Number': 'PLNumber',
+    'Expiration Date': 'Expires',
+    'Classification': 'Classification',
+    'County': 'County' }
+PARAMS = {
+    'PageNum_WVNUMBER': 1,
+    'wvnumber': '',
+    'contractor_name': '',
+    'city_name': '',
+    'County': '',
+    'Submit3': 'Search+Plumbers'
+}
 
 def parse_row(row):
     data = {}
@@ -28,68 +43,63 @@ def parse_row(row):
     return data
 
 def extract_plumbers(html):
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = util.soup(html)
     rows = soup.find_all('tr')
     for row in rows[1:]:
         yield parse_row(row)
 
-def write_json(filename, data):
-    with open(filename, 'w', encoding='utf8') as fp:
-        json.dump(data, fp, indent=2)
+def fetch_page(page):
+    params = dict(PARAMS, PageNum_WVNUMBER=page)
+    resp = util.client().get(URL, params=params)
+    resp.raise_for_status()
+    return resp.text
+
+def parse_page(html):
+    return list(extract_plumbers(html))
+
+def page_count(html):
+    # The pager links (Next, Last) carry the page numbers
+    pages = re.findall(r'PageNum_WVNUMBER=(\d+)', html)
+    return max(map(int, pages), default=1)
+
+def fetch_pages(workers=8):
+
+    first = fetch_page(1)
+    pages = range(2, page_count(first) + 1)
+    print('Fetching', len(pages) + 1, 'pages')
+
+    # Fetch on threads, parse on processes, one list of rows per page
+    htmls = itertools.chain([first], util.ordered_map(fetch_page, pages, workers))
+
+    # spawn, the fetch threads are already running when workers start.
+    # The parse window pulls pages as rows are consumed, pool.map
+    # would drain every fetch up front
+    spawn = functools.partial(ProcessPoolExecutor, mp_context=mp.get_context('spawn'))
+    yield from util.ordered_map(parse_page, htmls, os.cpu_count() or 1, spawn)
 
 def fetch_plumbers():
-    
-    params = {
-        'PageNum_WVNUMBER': 1,
-        'wvnumber': '',
-        'contractor_name': '',
-        'city_name': '',
-        'County': '',
-        'Submit3': 'Search+Plumbers'
-    }
-
-    for p in range(1, 264):
-        params['PageNum_WVNUMBER'] = p
-        resp = rq.get(URL, params=params)
-        html = resp.text
-        yield from extract_plumbers(html)
-
-def format_record(record):
-
-    data = OrderedDict.fromkeys(util.COLUMNS)
-    name = nameparser.HumanName(record['Name'])
-    exp = dt.datetime.strptime(record['Expires'], '%Y-%m-%d')
-
-    # missing classification
-    data['Last Name'] = name.last
-    data['First Name'] = name.first
-    data['City'] = record['City']
-    data['State'] = 'West Virginia'
-    data['License Status'] = 'Expired' if exp < dt.datetime.now() else 'Active'
-    data['License Number'] = record['PLNumber']
-
-    data['Expiration Date'] = record['Expires']
-    data['Classification'] = record['Classification']
-    data['County'] = record['County']
+    for rows in fetch_pages():
+        yield from rows
 
-    return data
+def unique_record(record):
+    return (record['PLNumber'], record['Name'])
+
+def export_table(records):
+    df = util.export_frame(records, FIELDS, name='Name')
+    df['State'] = 'West Virginia'
+    df['License Status'] = util.expiry_status(df['Expiration Date'], '%Y-%m-%d')
+    return df
 
 def export_csv():
-    data = util.read_json('westvirginia.json')
-    df = pd.DataFrame([ format_record(x) for x in data ])
+    df = export_table(util.load_records(STATE, FILENAME))
     df.to_csv('./westvirginia.csv', index=None)
 
 def main():
 
-    filename = 'westvirginia.json'
-    results = []
-    cont = 1
-
-    for record in fetch_plumbers():
-        results.append(record)
-        print('[{}/6289] {}'.format(cont, record['PLNumber']))
-        write_json(filename, results)
-        cont += 1
+    with util.RecordStore(STATE, unique_record, FILENAME) as store:
+        for rows in fetch_pages():
+            store.extend(rows)
+            print('[{}] records'.format(len(store)))
             
 if __name__ == '__main__':
     main()